@@ -1,31 +1,88 @@
+import json
 import threading
-from flask import Flask, request, jsonify
+import time
+from types import SimpleNamespace
+from typing import Optional
+from flask import Flask, Response, request, jsonify
 from datetime import datetime
 from shared.logger import setup_logger
 
+try:
+    from waitress import serve
+except ImportError:
+    serve = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# Схемы входящих команд от сервера: поле -> значение по умолчанию
+CLOSE_SESSION_FIELDS = {'session_id': None, 'file_path': None, 'username': None, 'ended_at': None}
+COMMENT_CREATED_FIELDS = {'session_id': None, 'file_path': None, 'username': None, 'comment': {}}
+
+if msgspec is not None:
+    class CloseSessionPayload(msgspec.Struct):
+        session_id: Optional[str] = None
+        file_path: Optional[str] = None
+        username: Optional[str] = None
+        ended_at: Optional[str] = None
+
+    class CommentCreatedPayload(msgspec.Struct):
+        session_id: Optional[str] = None
+        file_path: Optional[str] = None
+        username: Optional[str] = None
+        comment: dict = msgspec.field(default_factory=dict)
+
+    # Декодеры компилируются один раз и разбирают JSON сразу в структуры
+    _close_session_decoder = msgspec.json.Decoder(CloseSessionPayload)
+    _comment_created_decoder = msgspec.json.Decoder(CommentCreatedPayload)
+    _payload_errors = (msgspec.DecodeError, msgspec.ValidationError)
+else:
+    _close_session_decoder = None
+    _comment_created_decoder = None
+    _payload_errors = (ValueError,)
+
 class AgentServer:
-       def __init__(self, event_handler, port=8080):
+       def __init__(self, event_handler, port=8080, threads=16, connection_limit=1000):
            self.event_handler = event_handler
            self.port = port
+           self.threads = threads
+           self.connection_limit = connection_limit
+           # Кэш тела ответа /health (обновляется не чаще раза в секунду)
+           self._health_body = b''
+           self._health_body_ts = 0.0
            self.logger = setup_logger(__name__)
            self.app = Flask(__name__)
            self._setup_routes()
        
+       def _parse_payload(self, decoder, fields: dict):
+           """Разбирает тело запроса (msgspec, если установлен, иначе request.json)"""
+           if decoder is not None:
+               return decoder.decode(request.get_data(cache=False))
+           data = request.get_json(silent=True)
+           if not isinstance(data, dict):
+               raise ValueError("Request body must be a JSON object")
+           return SimpleNamespace(**{name: data.get(name, default) for name, default in fields.items()})
+       
        def _setup_routes(self):
            @self.app.route('/api/agent/close-session', methods=['POST'])
            def close_session():
                try:
-                   data = request.json
-                   session_id = data.get('session_id')
-                   file_path = data.get('file_path')
-                   username = data.get('username')
-                   ended_at = data.get('ended_at')
+                   try:
+                       data = self._parse_payload(_close_session_decoder, CLOSE_SESSION_FIELDS)
+                   except _payload_errors as e:
+                       self.logger.warning(f"⚠️ Invalid close-session payload: {e}")
+                       return jsonify({"status": "invalid_data", "message": str(e)}), 400
+                   session_id = data.session_id
+                   file_path = data.file_path
+                   username = data.username
+                   ended_at = data.ended_at
            
                    self.logger.info(f"🔄 Received close-session command: {file_path} by {username}")
            
                    if file_path and username:
-                       session_key = f"{file_path}:{username}"
-                       if session_key not in self.event_handler.session_manager.active_sessions:
+                       if not self.event_handler.session_manager.has_active_session(file_path, username):
                            self.logger.info(f"ℹ️ Session already closed or not found: {file_path} by {username}")
                            return jsonify({
                                "status": "already_closed", 
@@ -55,23 +112,20 @@ class AgentServer:
            @self.app.route('/api/agent/comment-created', methods=['POST'])
            def comment_created():
                try:
-                   data = request.json
-                   session_id = data.get('session_id')
-                   file_path = data.get('file_path')
-                   username = data.get('username')
-                   comment_data = data.get('comment', {})
+                   try:
+                       data = self._parse_payload(_comment_created_decoder, COMMENT_CREATED_FIELDS)
+                   except _payload_errors as e:
+                       self.logger.warning(f"⚠️ Invalid comment payload: {e}")
+                       return jsonify({"status": "invalid_data", "message": str(e)}), 400
+                   session_id = data.session_id
+                   file_path = data.file_path
+                   username = data.username
+                   comment_data = data.comment or {}
                    
                    self.logger.info(f"💬 Received comment notification: {file_path} by {username}")
                    
                    if file_path:
-                       self.event_handler.commented_files[file_path] = {
-                           'commented_at': datetime.now(),
-                           'username': username,
-                           'session_id': session_id,
-                           'content': comment_data.get('content', ''),
-                           'change_type': comment_data.get('change_type', 'other'),
-                           'created_at': comment_data.get('created_at', datetime.now().isoformat())
-                       }
+                       self.event_handler.track_commented_file(file_path, username, session_id, comment_data)
                        
                        if file_path and username:
                            self.event_handler.session_manager.close_session(file_path, username)
@@ -87,15 +141,23 @@ class AgentServer:
            
            @self.app.route('/api/agent/health', methods=['GET'])
            def health():
-               return jsonify({
-                   "status": "healthy", 
-                   "service": "monitoring-agent",
-                   "timestamp": datetime.now().isoformat()
-               })
+               now = time.time()
+               if now - self._health_body_ts > 1.0:
+                   # Гонка потоков безопасна: в худшем случае тело пересоберется лишний раз
+                   self._health_body = json.dumps({
+                       "status": "healthy", 
+                       "service": "monitoring-agent",
+                       "timestamp": datetime.fromtimestamp(now).isoformat()
+                   }).encode('utf-8')
+                   self._health_body_ts = now
+               return Response(self._health_body, mimetype='application/json')
 
            @self.app.route('/api/agent/active-sessions', methods=['GET'])
            def get_active_sessions():
                try:
+                   # Снимок значений делается за один вызов на C-уровне, поэтому
+                   # параллельные изменения словаря другими потоками не мешают итерации
+                   sessions_snapshot = tuple(self.event_handler.session_manager.active_sessions.values())
                    sessions = [
                        {
                            "session_id": session_data["session_id"],
@@ -107,7 +169,7 @@ class AgentServer:
                            "resume_count": session_data.get("resume_count", 0),
                            "is_commented": session_data.get("is_commented", False)
                        }
-                       for session_data in self.event_handler.session_manager.active_sessions.values()
+                       for session_data in sessions_snapshot
                    ]
                    self.logger.info("Returning active sessions list")
                    return jsonify({"status": "success", "sessions": sessions})
@@ -117,16 +179,29 @@ class AgentServer:
        
        def start(self):
            try:
-               thread = threading.Thread(
-                   target=lambda: self.app.run(
-                       host='0.0.0.0', 
-                       port=self.port, 
-                       debug=False, 
-                       use_reloader=False
-                   ),
-                   daemon=True
-               )
+               thread = threading.Thread(target=self._serve, daemon=True)
                thread.start()
                self.logger.info(f"🎯 Agent server started on port {self.port}")
            except Exception as e:
-               self.logger.error(f"❌ Failed to start agent server: {e}")
\ No newline at end of file
+               self.logger.error(f"❌ Failed to start agent server: {e}")
+
+       def _serve(self):
+           """Запускает WSGI сервер (waitress, если установлен)"""
+           if serve is not None:
+               # Соединения обслуживает асинхронный цикл waitress, потоки нужны только обработчикам
+               serve(
+                   self.app,
+                   host='0.0.0.0',
+                   port=self.port,
+                   threads=self.threads,
+                   connection_limit=self.connection_limit
+               )
+           else:
+               self.logger.warning("waitress not installed, falling back to Flask dev server")
+               self.app.run(
+                   host='0.0.0.0', 
+                   port=self.port, 
+                   debug=False, 
+                   use_reloader=False,
+                   threaded=True
+               )
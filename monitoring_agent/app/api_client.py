@@ -1,11 +1,45 @@
+import atexit
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import time
 import json
 import os
+import queue
+import random
+import threading
 from typing import Optional, Dict, Any
 from shared.logger import setup_logger
 from shared.config_loader import get_api_client_config
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+# Один переиспользуемый кодировщик msgspec (буфер не выделяется заново на каждый вызов)
+_msgspec_encoder = msgspec.json.Encoder() if msgspec is not None else None
+
+def _json_dumps(obj) -> bytes:
+    """Сериализует объект в JSON (orjson, затем msgspec, если установлены)"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    if _msgspec_encoder is not None:
+        return _msgspec_encoder.encode(obj)
+    return json.dumps(obj).encode('utf-8')
+
+if orjson is not None:
+    _json_loads = orjson.loads
+elif msgspec is not None:
+    _json_loads = msgspec.json.decode
+else:
+    _json_loads = json.loads
+
 class APIClient:
     def __init__(self):
         self.config = get_api_client_config()
@@ -13,97 +47,402 @@ class APIClient:
         self.events_endpoint = self.config.get('events_endpoint', '/api/events')
         self.timeout = self.config.get('timeout', 10)
         self.retry_attempts = self.config.get('retry_attempts', 3)
-        self.event_cache_file = self.config.get('event_cache_file', 'event_cache.json')
+        self.event_cache_file = self.config.get('event_cache_file', 'event_cache.jsonl')
+        self.batch_endpoint = self.config.get('batch_endpoint', f"{self.events_endpoint}/batch")
+        self.batch_size = self.config.get('batch_size', 64)
+        # Кэш отправляется крупными пакетами: задержка здесь не важна, важно число RTT
+        self.cache_batch_size = self.config.get('cache_batch_size', 500)
+        self.cache_retry_interval = self.config.get('cache_retry_interval', 30)
+        self.batch_interval = self.config.get('batch_interval', 0.05)
+        self.backoff_base = self.config.get('backoff_base', 0.1)
+        self.backoff_cap = self.config.get('backoff_cap', 30.0)
         self.logger = setup_logger(__name__)
+        
+        # URL вычисляются один раз
+        self._batch_url = f"{self.base_url}{self.batch_endpoint}"
+        self._events_url = f"{self.base_url}{self.events_endpoint}"
+        # Сбрасывается, если сервер не поддерживает пакетный эндпоинт (404/405)
+        self._batch_supported = True
+        self._sessions_url = f"{self.base_url}/api/sessions"
+        self._health_url = f"{self.base_url}/health"
+        self._json_headers = {'Content-Type': 'application/json'}
+        
+        self.session = self._create_session()
+        self._cache_lock = threading.Lock()
         self.event_cache = self._load_event_cache()
+        # После переполнения очереди новые события идут в кэш, пока диспетчер не отправит его,
+        # чтобы они не обогнали уже закэшированные (флаг меняется под _cache_lock)
+        self._overflow = False
+        self._next_cache_retry = 0.0
+        
+        # Очередь событий и фоновый диспетчер пакетной отправки
+        self.event_queue = queue.Queue(maxsize=self.config.get('queue_size', 10000))
+        self._stop_event = threading.Event()
+        self._dispatcher = threading.Thread(target=self._dispatcher_loop, daemon=True)
+        self._dispatcher.start()
+        # Очередь дренируется и при выходе интерпретатора без явного close()
+        atexit.register(self.close)
         
         self.logger.info(f"API Client configured for: {self.base_url}")
     
+    def _create_session(self) -> requests.Session:
+        """Создает HTTP сессию с пулом keep-alive соединений"""
+        session = requests.Session()
+        # Повторы выполняем сами в _send_batch, поэтому Retry(total=0)
+        adapter = HTTPAdapter(
+            pool_connections=self.config.get('pool_connections', 32),
+            pool_maxsize=self.config.get('pool_maxsize', 64),
+            max_retries=Retry(total=0)
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+    
     def _load_event_cache(self) -> list:
-        """Загружает кэш событий из файла"""
+        """Загружает кэш событий из JSON-lines файла (одно событие на строку)"""
+        events = []
+        legacy_files = []
         try:
+            # Прежний формат: JSON-массив в event_cache.json рядом с новым файлом
+            legacy_file = os.path.splitext(self.event_cache_file)[0] + '.json'
+            if legacy_file != self.event_cache_file and os.path.exists(legacy_file):
+                legacy_events = self._load_legacy_event_cache(legacy_file)
+                if legacy_events is not None:
+                    events.extend(legacy_events)
+                    legacy_files.append(legacy_file)
+            
             if os.path.exists(self.event_cache_file):
-                with open(self.event_cache_file, 'r') as f:
-                    return json.load(f)
-            return []
+                with open(self.event_cache_file, 'rb') as f:
+                    content = f.read()
+                if content.lstrip()[:1] == b'[':
+                    # Настроенный файл сам ещё в формате массива - перезаписывается ниже как JSON-lines
+                    legacy_events = self._load_legacy_event_cache(self.event_cache_file)
+                    if legacy_events is None:
+                        # Нечитаемый файл откладываем в сторону, чтобы дозапись не смешала форматы
+                        self._retire_legacy_event_cache(self.event_cache_file, '.corrupt')
+                    else:
+                        events.extend(legacy_events)
+                        legacy_files.append(self.event_cache_file)
+                else:
+                    for line in content.splitlines():
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            events.append(_json_loads(line))
+                        except ValueError:
+                            self.logger.warning(f"Skipping corrupted event cache line: {line[:100]!r}")
+            
+            # Перенос выполняется только если оба файла прочитаны полностью
+            if legacy_files:
+                self.event_cache = events
+                if self._save_event_cache():
+                    for legacy_file in legacy_files:
+                        if legacy_file != self.event_cache_file:
+                            self._retire_legacy_event_cache(legacy_file)
+                    self.logger.info(f"Migrated {len(events)} cached events to JSON-lines cache: {self.event_cache_file}")
         except Exception as e:
             self.logger.error(f"Failed to load event cache: {e}")
-            return []
+        return events
+    
+    def _load_legacy_event_cache(self, path: str) -> Optional[list]:
+        """Читает кэш событий в прежнем формате (JSON-массив); None если файл не читается"""
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+            if not content.strip():
+                return []
+            events = _json_loads(content)
+            if not isinstance(events, list):
+                raise ValueError("not a JSON array")
+            return events
+        except Exception as e:
+            self.logger.error(f"Failed to load legacy event cache {path}: {e}")
+            return None
+    
+    def _retire_legacy_event_cache(self, path: str, suffix: str = '.migrated'):
+        """Переименовывает кэш прежнего формата, чтобы он не загружался повторно"""
+        try:
+            os.replace(path, f"{path}{suffix}")
+        except OSError as e:
+            self.logger.error(f"Failed to rename legacy event cache {path}: {e}")
+    
+    def _append_events_to_cache(self, events: list):
+        """Дописывает события в конец кэш-файла (вызывать под _cache_lock)"""
+        lines = []
+        cached = []
+        for event_data in events:
+            try:
+                lines.append(_json_dumps(event_data) + b'\n')
+                cached.append(event_data)
+            except (TypeError, ValueError) as e:
+                # Несериализуемое событие не может быть отправлено никогда - не отравляем им кэш
+                self.logger.error(f"Dropping unserializable event: {e} {event_data!r}")
+        self.event_cache.extend(cached)
+        try:
+            with open(self.event_cache_file, 'ab') as f:
+                f.write(b''.join(lines))
+        except Exception as e:
+            self.logger.error(f"Failed to append to event cache: {e}")
     
-    def _save_event_cache(self):
-        """Сохраняет кэш событий в файл"""
+    def _save_event_cache(self) -> bool:
+        """Атомарно перезаписывает (компактирует) кэш-файл (вызывать под _cache_lock)"""
+        tmp_file = f"{self.event_cache_file}.tmp"
         try:
-            with open(self.event_cache_file, 'w') as f:
-                json.dump(self.event_cache, f)
+            with open(tmp_file, 'wb') as f:
+                f.write(b''.join(_json_dumps(event_data) + b'\n' for event_data in self.event_cache))
+            os.replace(tmp_file, self.event_cache_file)
+            return True
         except Exception as e:
             self.logger.error(f"Failed to save event cache: {e}")
+            return False
     
     def send_event(self, event_data: Dict[str, Any]) -> bool:
-        """Отправляет событие на сервер с повторными попытками"""
-        full_url = f"{self.base_url}{self.events_endpoint}"
-        self.logger.debug(f"Sending event to {full_url}: {event_data}")
+        """Ставит событие в очередь на отправку фоновым диспетчером"""
+        return self.send_events_batch([event_data])
+    
+    def send_events_batch(self, events: list) -> bool:
+        """Ставит в очередь сразу несколько событий; не поместившиеся кэширует одной записью"""
+        with self._cache_lock:
+            overflow = events
+            if not self._overflow:
+                overflow = []
+                for i, event_data in enumerate(events):
+                    try:
+                        self.event_queue.put_nowait(event_data)
+                    except queue.Full:
+                        overflow = events[i:]
+                        self._overflow = True
+                        self._next_cache_retry = 0.0
+                        self.logger.error("Event queue is full, caching events until the cache is replayed")
+                        break
+            if not overflow:
+                return True
+            
+            self.logger.debug("Caching %s events while event queue is overflowed", len(overflow))
+            self._append_events_to_cache(overflow)
+        return False
+    
+    def flush(self, timeout: float = 10) -> bool:
+        """Дожидается отправки всех событий, поставленных в очередь"""
+        deadline = time.monotonic() + timeout
+        with self.event_queue.all_tasks_done:
+            while self.event_queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.event_queue.all_tasks_done.wait(remaining)
+        return True
+    
+    def _dispatcher_loop(self):
+        """Фоновый цикл: собирает события в пакеты и отправляет их"""
+        while not self._stop_event.is_set() or not self.event_queue.empty():
+            batch = self._collect_batch()
+            if batch:
+                try:
+                    self._send_batch(batch)
+                except Exception as e:
+                    # Единственный поток диспетчера не должен завершаться из-за одного пакета
+                    self.logger.error(f"❌ Error sending batch of {len(batch)} events, caching: {e}")
+                    with self._cache_lock:
+                        self._append_events_to_cache(batch)
+                finally:
+                    for _ in batch:
+                        self.event_queue.task_done()
+            try:
+                self._maybe_retry_cached_events()
+            except Exception as e:
+                self.logger.error(f"❌ Error retrying cached events: {e}")
+    
+    def _collect_batch(self) -> list:
+        """Собирает пакет событий из очереди (до batch_size или batch_interval)"""
+        try:
+            batch = [self.event_queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        
+        deadline = time.monotonic() + self.batch_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.event_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+    
+    def _send_batch(self, batch: list) -> bool:
+        """Отправляет пакет событий на сервер с повторными попытками"""
+        self.logger.debug("Sending batch of %s events to %s", len(batch), self._batch_url)
         
+        payload = _json_dumps(batch)
+        backoff = self.backoff_base
         for attempt in range(self.retry_attempts):
             try:
-                response = requests.post(
-                    full_url,
-                    json=event_data,
-                    timeout=self.timeout
-                )
-                
-                if response.status_code == 200:
-                    self.logger.debug(f"Event sent successfully: {event_data.get('event_type')} for {event_data.get('file_path')}")
-                    # Try sending cached events
-                    self._retry_cached_events()
+                rejected = self._post_events(batch, payload)
+                if rejected is not None:
+                    self._cache_rejected_events(rejected)
+                    self.logger.debug("Batch of %s events sent successfully", len(batch))
                     return True
-                else:
-                    self.logger.warning(f"API returned {response.status_code}: {response.text} for event: {event_data}")
                     
             except requests.exceptions.RequestException as e:
-                self.logger.warning(f"Attempt {attempt + 1} failed: {e} for event: {event_data}")
+                self.logger.warning(f"Attempt {attempt + 1} failed: {e} for batch of {len(batch)} events")
                 
             if attempt < self.retry_attempts - 1:
-                time.sleep(2 ** attempt)  # Exponential backoff
+                # Decorrelated jitter; прерывается при остановке клиента
+                backoff = self._next_backoff(backoff)
+                self._stop_event.wait(backoff)
         
-        self.logger.error(f"Failed to send event after {self.retry_attempts} attempts to {full_url}: {event_data}")
-        # Cache the event
-        self.event_cache.append(event_data)
-        self._save_event_cache()
+        self.logger.error(f"Failed to send batch after {self.retry_attempts} attempts to {self._batch_url}: {len(batch)} events cached")
+        # Cache the events
+        with self._cache_lock:
+            self._append_events_to_cache(batch)
         return False
     
-    def _retry_cached_events(self):
-        """Пытается отправить кэшированные события"""
-        if not self.event_cache:
-            return
+    def _next_backoff(self, prev: float) -> float:
+        """Вычисляет следующую задержку повтора (decorrelated jitter)"""
+        return min(self.backoff_cap, random.uniform(self.backoff_base, max(self.backoff_base, prev * 3)))
+    
+    def _post_events(self, batch: list, payload: bytes = None) -> Optional[list]:
+        """Отправляет пакет; возвращает отклоненные сервером события или None, если пакет не принят"""
+        if not self._batch_supported:
+            return self._post_events_one_by_one(batch)
         
-        full_url = f"{self.base_url}{self.events_endpoint}"
-        remaining_events = []
-        for event_data in self.event_cache:
+        response = self.session.post(
+            self._batch_url,
+            data=payload if payload is not None else _json_dumps(batch),
+            headers=self._json_headers,
+            timeout=self.timeout
+        )
+        if response.status_code in (404, 405):
+            self._batch_supported = False
+            self.logger.error(f"❌ Batch endpoint is not available ({response.status_code}): {self._batch_url}, "
+                              f"falling back to single event requests to {self._events_url}")
+            return self._post_events_one_by_one(batch)
+        if response.status_code != 200:
+            self.logger.warning(f"API returned {response.status_code}: {response.text} for batch of {len(batch)} events")
+            return None
+        
+        try:
+            results = response.json().get('results')
+        except (ValueError, AttributeError):
+            results = None
+        if not isinstance(results, list):
+            # Пакет принят, но результаты по событиям прочитать нельзя - повтор дал бы дубликаты
+            self.logger.warning(f"Malformed batch response for {len(batch)} events: {response.text[:200]}")
+            return []
+        return [event_data for event_data, result in zip(batch, results)
+                if isinstance(result, dict) and result.get('status') == 'error']
+    
+    def _post_events_one_by_one(self, batch: list) -> list:
+        """Отправляет события по одному на events_endpoint (сервер без пакетного эндпоинта)"""
+        for i, event_data in enumerate(batch):
             try:
-                response = requests.post(
-                    full_url,
-                    json=event_data,
+                response = self.session.post(
+                    self._events_url,
+                    data=_json_dumps(event_data),
+                    headers=self._json_headers,
                     timeout=self.timeout
                 )
-                if response.status_code == 200:
-                    self.logger.info(f"Successfully sent cached event: {event_data.get('event_type')} for {event_data.get('file_path')}")
-                else:
-                    self.logger.warning(f"Failed to send cached event: {response.status_code} {response.text}")
-                    remaining_events.append(event_data)
             except requests.exceptions.RequestException as e:
-                self.logger.warning(f"Failed to send cached event: {e}")
-                remaining_events.append(event_data)
+                # Отправленные события не повторяются; остаток уходит в кэш
+                self.logger.warning(f"Failed to send event to {self._events_url}: {e}")
+                return batch[i:]
+            if response.status_code != 200:
+                self.logger.warning(f"API returned {response.status_code}: {response.text} for event: {event_data}")
+                return batch[i:]
+        return []
+    
+    def _cache_rejected_events(self, rejected: list):
+        """Кэширует события, которые сервер не смог обработать"""
+        if not rejected:
+            return
+        
+        for event_data in rejected:
+            self.logger.warning(f"Server rejected event: {event_data}")
+        with self._cache_lock:
+            self._append_events_to_cache(rejected)
+    
+    def _maybe_retry_cached_events(self):
+        """Повторяет отправку кэша не чаще cache_retry_interval; после переполнения - как только опустеет очередь"""
+        if not self.event_cache or self._stop_event.is_set():
+            return
+        # Сначала уходят более ранние события, уже стоящие в очереди
+        if self._overflow and not self.event_queue.empty():
+            return
+        if time.monotonic() < self._next_cache_retry:
+            return
+        
+        sent = self._retry_cached_events()
+        # При переполнении продолжаем, пока кэш отправляется; иначе ждем интервал
+        if not (self._overflow and sent):
+            self._next_cache_retry = time.monotonic() + self.cache_retry_interval
+    
+    def _retry_cached_events(self) -> int:
+        """Пытается отправить кэшированные события (из потока диспетчера); возвращает число отправленных"""
+        # Сеть - без лока: переполнение очереди не ждет завершения POST запросов
+        with self._cache_lock:
+            snapshot = self.event_cache[:]
+        if not snapshot:
+            return 0
+        
+        remaining_events = []
+        for i in range(0, len(snapshot), self.cache_batch_size):
+            batch = snapshot[i:i + self.cache_batch_size]
+            try:
+                failed = self._post_events(batch)
+                if failed is not None:
+                    self.logger.info(f"Successfully sent {len(batch) - len(failed)} cached events")
+                    remaining_events.extend(failed)
+                    # При поштучной отправке неотправленное - это хвост пакета: остальные ждут его
+                    if not failed or self._batch_supported:
+                        continue
+                    remaining_events.extend(snapshot[i + len(batch):])
+                    break
+            except requests.exceptions.RequestException as e:
+                self.logger.warning(f"Failed to send cached events: {e}")
+            # Более поздние события не обгоняют неотправленные
+            remaining_events.extend(snapshot[i:])
+            break
+        
+        with self._cache_lock:
+            # События, закэшированные во время отправки, остаются после неотправленных
+            self.event_cache = remaining_events + self.event_cache[len(snapshot):]
+            # Компактируем файл только если что-то изменилось
+            if len(remaining_events) != len(snapshot):
+                self._save_event_cache()
+            if not self.event_cache:
+                self._overflow = False
+        return len(snapshot) - len(remaining_events)
+    
+    def close(self, timeout: float = 10):
+        """Останавливает диспетчер, дожидаясь отправки очереди; неотправленное сохраняет в кэш"""
+        self._stop_event.set()
+        if self._dispatcher.is_alive():
+            self._dispatcher.join(timeout=timeout)
         
-        self.event_cache = remaining_events
-        self._save_event_cache()
+        # События, которые диспетчер не успел отправить, переживают перезапуск через кэш-файл
+        leftover = []
+        while True:
+            try:
+                leftover.append(self.event_queue.get_nowait())
+            except queue.Empty:
+                break
+            self.event_queue.task_done()
+        if leftover:
+            self.logger.warning(f"Caching {len(leftover)} unsent events on shutdown")
+            with self._cache_lock:
+                self._append_events_to_cache(leftover)
+        self.session.close()
     
     def create_file_session(self, session_data: Dict[str, Any]) -> Optional[str]:
         """Создает сессию на сервере и возвращает session_id"""
-        full_url = f"{self.base_url}/api/sessions"
         try:
-            response = requests.post(
-                full_url,
-                json=session_data,
+            response = self.session.post(
+                self._sessions_url,
+                data=_json_dumps(session_data),
+                headers=self._json_headers,
                 timeout=self.timeout
             )
             
@@ -111,26 +450,25 @@ class APIClient:
                 result = response.json()
                 return result.get('id')
             else:
-                self.logger.error(f"Failed to create session: {response.status_code} {response.text} for URL: {full_url}")
+                self.logger.error(f"Failed to create session: {response.status_code} {response.text} for URL: {self._sessions_url}")
                 
         except requests.exceptions.RequestException as e:
-            self.logger.error(f"Error creating session: {e} for URL: {full_url}")
+            self.logger.error(f"Error creating session: {e} for URL: {self._sessions_url}")
         
         return None
     
     def test_connection(self) -> bool:
         """Проверяет соединение с API"""
-        full_url = f"{self.base_url}/health"
         try:
-            response = requests.get(full_url, timeout=5)
+            response = self.session.get(self._health_url, timeout=5)
             if response.status_code == 200:
-                self.logger.info(f"API connection successful: {full_url}")
-                # Try sending cached events on successful connection
-                self._retry_cached_events()
+                self.logger.info(f"API connection successful: {self._health_url}")
+                # Кэш отправит диспетчер при следующей итерации
+                self._next_cache_retry = 0.0
                 return True
             else:
-                self.logger.error(f"API connection failed: {response.status_code} {response.text} for URL: {full_url}")
+                self.logger.error(f"API connection failed: {response.status_code} {response.text} for URL: {self._health_url}")
                 return False
         except requests.exceptions.RequestException as e:
-            self.logger.error(f"API connection failed: {e} for URL: {full_url}")
+            self.logger.error(f"API connection failed: {e} for URL: {self._health_url}")
             return False
\ No newline at end of file
@@ -5,7 +5,7 @@ from datetime import datetime
 from shared.logger import setup_logger
 
 class BackgroundSessionChecker:
-    def __init__(self, event_handler, check_interval=10):
+    def __init__(self, event_handler, check_interval=10, orphan_check_interval=60):
         self.event_handler = event_handler
         self.check_interval = check_interval
         self.adaptive_interval = check_interval  # Адаптивный интервал
@@ -14,6 +14,10 @@ class BackgroundSessionChecker:
         self._thread = None
         self.last_session_count = 0
         
+        # Поиск orphaned сессий (stat каждого файла) выполняется реже основной проверки
+        self.orphan_check_interval = orphan_check_interval
+        self._last_orphan_check = 0.0
+        
     def start(self):
         """Запускает фоновую проверку сессий"""
         if self._thread and self._thread.is_alive():
@@ -41,8 +45,12 @@ class BackgroundSessionChecker:
             except Exception as e:
                 self.logger.error(f"Error in background session checker: {e}")
                 
-            # Ждем указанный интервал
-            self._stop_event.wait(self.check_interval)
+            # Ждем до ближайшего истечения сессии, но не дольше интервала проверки
+            wait_seconds = self.check_interval
+            next_expiry = self.event_handler.session_manager.next_expiry_in()
+            if next_expiry is not None:
+                wait_seconds = min(wait_seconds, next_expiry)
+            self._stop_event.wait(wait_seconds)
             
     def _adjust_check_interval(self):
         """Адаптивно настраивает интервал проверок based on нагрузки"""
@@ -74,8 +82,11 @@ class BackgroundSessionChecker:
             # Проверяем открытые файлы
             self.event_handler.check_open_files()
             
-            # Очищаем orphaned сессии
-            self.event_handler.cleanup_orphaned_sessions()
+            # Очищаем orphaned сессии не чаще orphan_check_interval
+            now = time.monotonic()
+            if now - self._last_orphan_check >= self.orphan_check_interval:
+                self._last_orphan_check = now
+                self.event_handler.cleanup_orphaned_sessions()
             
             # Получаем статистику ПОСЛЕ проверки
             active_after = len(self.event_handler.session_manager.active_sessions)
@@ -84,124 +95,30 @@ class BackgroundSessionChecker:
             if expired_count > 0:
                 self.logger.info(f"✅ Background check: closed {expired_count} expired sessions")
             elif active_before > 0:
-                self.logger.debug(f"📊 Background check: {active_after}/{active_before} sessions still active")
+                self.logger.debug("📊 Background check: %s/%s sessions still active", active_after, active_before)
             else:
                 self.logger.debug("💤 Background check: no active sessions")
                 
         except Exception as e:
             self.logger.error(f"❌ Error in background session check: {e}")
     
-    def _check_expired_sessions_aggressive(self):
-        """Агрессивно проверяет и закрывает просроченные сессии - ИСПРАВЛЕННАЯ ВЕРСИЯ"""
-        try:
-            # Используем прямой вызов менеджера сессий
-            expired_sessions = self.event_handler.session_manager.check_and_close_expired_sessions()
-            closed_count = 0
-            
-            for session_data in expired_sessions:
-                file_path = session_data['file_path']
-                username = session_data['username']
-                
-                # ПРОВЕРЯЕМ ЧТО ended_at УСТАНОВЛЕНО
-                if 'ended_at' not in session_data or session_data['ended_at'] is None:
-                    self.logger.error(f"❌ Session closed but ended_at is None for: {file_path}")
-                    continue
-                
-                # Вычисляем финальный хеш если файл существует
-                file_hash = None
-                if self.event_handler.config.get('hashing', {}).get('enabled', True):
-                    file_hash = self.event_handler.hash_calculator.calculate_file_hash_with_retry(file_path)
-                
-                # Отправляем событие closed для expired сессии
-                event_data = {
-                    'file_path': file_path,
-                    'file_name': session_data.get('file_name', os.path.basename(file_path)),
-                    'event_type': 'closed',
-                    'file_hash': file_hash,
-                    'user_id': username,
-                    'session_id': session_data['session_id'],
-                    'resume_count': session_data.get('resume_count', 0),
-                    'session_duration': (session_data['ended_at'] - session_data['started_at']).total_seconds(),
-                    'event_timestamp': session_data['ended_at'].isoformat()  # ИСПОЛЬЗУЕМ ВРЕМЯ ЗАКРЫТИЯ СЕССИИ
-                }
-                
-                success = self.event_handler.api_client.send_event(event_data)
-                if success:
-                    self.logger.info(f"🕒 Closed expired session: {file_path} (ended_at: {session_data['ended_at']})")
-                    closed_count += 1
-                else:
-                    self.logger.error(f"❌ Failed to send closed event for: {file_path}")
-            
-            return closed_count
-            
-        except Exception as e:
-            self.logger.error(f"❌ Error in aggressive session check: {e}")
-            return 0
-        
-    # В background_checker.py добавим синхронизацию состояния
-
     def _check_expired_sessions_aggressive(self):
         """Агрессивно проверяет и закрывает просроченные сессии - ОБНОВЛЕННАЯ ВЕРСИЯ"""
         try:
             # Используем прямой вызов менеджера сессий
             expired_sessions = self.event_handler.session_manager.check_and_close_expired_sessions()
             closed_count = 0
-        
-            for session_data in expired_sessions:
-                file_path = session_data['file_path']
-                username = session_data['username']
+            if not expired_sessions:
+                return closed_count
             
-                # ПРОВЕРЯЕМ ЧТО ended_at УСТАНОВЛЕНО
-                if 'ended_at' not in session_data or session_data['ended_at'] is None:
-                    self.logger.error(f"❌ Session closed but ended_at is None for: {file_path}")
-                    continue
-            
-                # Проверяем не прокомментирован ли файл на сервере
-                if self.event_handler.is_file_commented(file_path):
-                    self.logger.debug(f"💬 Skipping expired session for commented file: {file_path}")
-                    continue
-            
-                #    Вычисляем финальный хеш если файл существует
-                file_hash = None
-                if self.event_handler.config.get('hashing', {}).get('enabled', True):
-                    file_hash = self.event_handler.hash_calculator.calculate_file_hash_with_retry(file_path)
-            
-                # Отправляем событие closed для expired сессии
-                event_data = {
-                    'file_path': file_path,
-                    'file_name': session_data.get('file_name', os.path.basename(file_path)),
-                    'event_type': 'closed',
-                    'file_hash': file_hash,
-                    'user_id': username,
-                    'session_id': session_data['session_id'],
-                    'resume_count': session_data.get('resume_count', 0),
-                    'session_duration': (session_data['ended_at'] - session_data['started_at']).total_seconds(),
-                    'event_timestamp': session_data['ended_at'].isoformat()  # ИСПОЛЬЗУЕМ ВРЕМЯ ЗАКРЫТИЯ СЕССИИ
-                }
+            # Выносим обращения к конфигурации и методам из цикла
+            is_file_commented = self.event_handler.is_file_commented
+            send_events_batch = self.event_handler._send_events_batch_ordered
             
-                success = self.event_handler.api_client.send_event(event_data)
-                if success:
-                    self.logger.info(f"🕒 Closed expired session: {file_path} (ended_at: {session_data['ended_at']})")
-                    closed_count += 1
-                else:
-                    self.logger.error(f"❌ Failed to send closed event for: {file_path}")
-        
-            return closed_count
-        
-        except Exception as e:
-            self.logger.error(f"❌ Error in aggressive session check: {e}")
-            return 0
-        
-    def _check_expired_sessions_aggressive(self):
-        """Агрессивно проверяет и закрывает просроченные сессии - ОБНОВЛЕННАЯ ВЕРСИЯ"""
-        try:
-            # Используем прямой вызов менеджера сессий
-            expired_sessions = self.event_handler.session_manager.check_and_close_expired_sessions()
-            closed_count = 0
-    
+            # Первый проход: отбираем сессии для закрытия
+            sessions_to_close = []
             for session_data in expired_sessions:
                 file_path = session_data['file_path']
-                username = session_data['username']
         
                 # ПРОВЕРЯЕМ ЧТО ended_at УСТАНОВЛЕНО
                 if 'ended_at' not in session_data or session_data['ended_at'] is None:
@@ -211,14 +128,25 @@ class BackgroundSessionChecker:
                     self.logger.info(f"✅ Manually set ended_at for: {file_path}")
             
                 # Проверяем не прокомментирован ли файл на сервере
-                if self.event_handler.is_file_commented(file_path):
-                    self.logger.debug(f"💬 Skipping expired session for commented file: {file_path}")
+                if is_file_commented(file_path):
+                    self.logger.debug("💬 Skipping expired session for commented file: %s", file_path)
                     continue
+                
+                sessions_to_close.append(session_data)
             
-                # Вычисляем финальный хеш если файл существует
-                file_hash = None
-                if self.event_handler.config.get('hashing', {}).get('enabled', True):
-                    file_hash = self.event_handler.hash_calculator.calculate_file_hash_with_retry(file_path)
+            # Хеширование - параллельно в пуле обработчика событий
+            file_hashes = self.event_handler._hash_files_parallel(
+                session_data['file_path'] for session_data in sessions_to_close
+            )
+    
+            # Второй проход: собираем хеши и события в исходном порядке
+            events = []
+            for session_data in sessions_to_close:
+                file_path = session_data['file_path']
+                username = session_data['username']
+            
+                # Финальный хеш (если файл существует)
+                file_hash = file_hashes.get(file_path)
             
                 # Отправляем событие closed для expired сессии
                 event_data = {
@@ -232,13 +160,16 @@ class BackgroundSessionChecker:
                     'session_duration': (session_data['ended_at'] - session_data['started_at']).total_seconds(),
                     'event_timestamp': session_data['ended_at'].isoformat()  # ИСПОЛЬЗУЕМ ВРЕМЯ ЗАКРЫТИЯ СЕССИИ
                 }
-            
-                success = self.event_handler.api_client.send_event(event_data)
-                if success:
-                    self.logger.info(f"🕒 Closed expired session: {file_path} (ended_at: {session_data['ended_at']})")
-                    closed_count += 1
+                events.append(event_data)
+            
+            # Все события закрытия отправляются одним пакетом
+            if events:
+                if send_events_batch(events):
+                    for event_data in events:
+                        self.logger.info(f"🕒 Closed expired session: {event_data['file_path']} (ended_at: {event_data['event_timestamp']})")
+                    closed_count += len(events)
                 else:
-                    self.logger.error(f"❌ Failed to send closed event for: {file_path}")
+                    self.logger.error(f"❌ Failed to enqueue {len(events)} closed events (cached for retry)")
     
             return closed_count
     
@@ -1,8 +1,15 @@
 import os
+import functools
+import html
 import getpass
+import logging
 import platform
+import re
+import sys
 import time
-import requests
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
 from typing import Dict, Any, Optional, List
 from shared.logger import setup_logger
@@ -10,10 +17,12 @@ from shared.config_loader import get_monitoring_config, get_api_client_config
 from .agent_server import AgentServer
 
 try:
+    import win32event
     import win32security
     import win32evtlog
     import win32evtlogutil
 except ImportError:
+    win32event = None
     win32security = None
     win32evtlog = None
     win32evtlogutil = None
@@ -28,6 +37,168 @@ from .session_manager import SessionManager
 from .api_client import APIClient
 from .file_validator import FileValidator
 
+# Пользователь агента и платформа не меняются за время работы процесса
+_CURRENT_USER = getpass.getuser()
+_IS_WINDOWS = platform.system() == 'Windows'
+
+# Подстроки имен временных файлов: одна проверка regex вместо цикла по списку
+_OFFICE_TEMP_RE = re.compile('|'.join(map(re.escape, ['~$', '~wr', '~wrd', '~wrl', '~rf', '.tmp'])))
+_CAD_TEMP_RE = re.compile('|'.join(map(re.escape, ['.dwl', '.dwl2', '.sv$', '.autosave', '.bak', '.lock'])))
+# Имена временных файлов Office из 4 или 8 шестнадцатеричных символов
+_HEX_TEMP_NAME_RE = re.compile(r'[0-9A-Fa-f]{4}(?:[0-9A-Fa-f]{4})?')
+
+# Стандартные имена новых документов Office и подстроки таких имен (в нижнем регистре)
+_OFFICE_DEFAULT_NAMES = frozenset([
+    'новый документ microsoft word.docx',
+    'новый документ microsoft word.doc',
+    'новая книга microsoft excel.xlsx',
+    'новая книга microsoft excel.xls',
+    'новая презентация microsoft powerpoint.pptx',
+    'новая презентация microsoft powerpoint.ppt',
+    'document.docx',
+    'document.doc',
+    'workbook.xlsx',
+    'workbook.xls',
+    'presentation.pptx',
+    'presentation.ppt',
+    'лист microsoft excel.xlsx',
+    'лист microsoft excel.xls',
+    'документ microsoft word.docx',
+    'документ microsoft word.doc'
+])
+_OFFICE_NAME_RE = re.compile('|'.join(map(re.escape, [
+    'новый ', 'новая ', 'new ', 'document', 'workbook', 'presentation', 'лист ', 'документ '
+])))
+_CAD_EXTENSIONS = frozenset([
+    '.dwg', '.dxf', '.dgn', '.rvt', '.rfa', '.rte', '.sat', '.ipt', '.iam', '.prt', '.asm',
+    '.sldprt', '.sldasm', '.3dm', '.skp', '.max', '.blend'
+])
+
+# Имя файла по пути: одно и то же значение нужно во многих обработчиках одного события
+_file_name = functools.lru_cache(maxsize=4096)(os.path.basename)
+
+@functools.lru_cache(maxsize=8192)
+def _normalize_path(path: str) -> str:
+    """Ключ сравнения путей (normpath + lower); открытые файлы повторяются между обновлениями индекса"""
+    return os.path.normpath(path).lower()
+
+def _open_file_key(path: str) -> str:
+    """Ключ индекса открытых файлов: дескрипторы процессов указывают на абсолютный реальный путь,
+    а события могут приходить с относительными путями или через символические ссылки"""
+    return _normalize_path(os.path.realpath(path))
+
+# Классификация зависит только от строки пути: при сериях сохранений пути повторяются
+@functools.lru_cache(maxsize=8192)
+def _is_office_creation_operation(file_path: str) -> bool:
+    """Определяет является ли файл частью операции создания Office документа"""
+    filename = _file_name(file_path).lower()
+    return filename in _OFFICE_DEFAULT_NAMES or _OFFICE_NAME_RE.search(filename) is not None
+
+@functools.lru_cache(maxsize=8192)
+def _is_office_temp_file(file_path: str) -> bool:
+    """Определяет является ли файл временным файлом Office"""
+    filename = _file_name(file_path)
+    
+    if _HEX_TEMP_NAME_RE.fullmatch(os.path.splitext(filename)[0]):
+        return True
+    
+    return _OFFICE_TEMP_RE.search(filename) is not None
+
+@functools.lru_cache(maxsize=8192)
+def _is_cad_operation(file_path: str) -> bool:
+    """Определяет является ли файл частью CAD операции"""
+    return os.path.splitext(file_path)[1].lower() in _CAD_EXTENSIONS
+
+@functools.lru_cache(maxsize=8192)
+def _is_cad_temp_file(file_path: str) -> bool:
+    """Определяет является ли файл временным файлом CAD"""
+    return _CAD_TEMP_RE.search(_file_name(file_path)) is not None
+
+_PATH_PREDICATES = (_is_office_creation_operation, _is_office_temp_file, _is_cad_operation, _is_cad_temp_file)
+
+def _try_stat(path: str) -> Optional[os.stat_result]:
+    """stat файла или None, если файла нет (один вызов вместо exists + stat)"""
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
+
+@functools.lru_cache(maxsize=1024)
+def _lookup_account_name(sid_string: str) -> Optional[str]:
+    """Разрешает SID в DOMAIN\\user (LookupAccountSid - дорогой вызов, владельцы повторяются)"""
+    sid = win32security.ConvertStringSidToSid(sid_string)
+    try:
+        name, domain, _ = win32security.LookupAccountSid(None, sid)
+    except win32security.error:
+        # Неразрешимый SID (удаленная учетная запись) кэшируется, чтобы не повторять RPC к LSA
+        return None
+    return f"{domain}\\{name}"
+
+# На Linux открытые файлы читаются напрямую из /proc/<pid>/fd
+_HAS_PROC_FS = sys.platform.startswith('linux') and os.path.isdir('/proc')
+_SYSTEM_PROCESS_NAMES = frozenset(['system', 'svchost.exe', 'explorer.exe'])
+_SYSTEM_USER_NAMES = frozenset(['system', 'network service'])
+
+@functools.lru_cache(maxsize=256)
+def _uid_to_username(uid: int) -> str:
+    """Имя пользователя по uid (pwd читает /etc/passwd - результат кэшируется)"""
+    import pwd
+    try:
+        return pwd.getpwuid(uid).pw_name
+    except KeyError:
+        return str(uid)
+
+# События доступа к файлам в журнале Security; фильтруются на стороне журнала
+AUDIT_EVENT_IDS = frozenset((4663, 4656, 4670))
+AUDIT_EVENTS_QUERY = "*[System[(%s)]]" % " or ".join(f"EventID={event_id}" for event_id in sorted(AUDIT_EVENT_IDS))
+# Из события рендерятся только два нужных поля, без построения XML и текста сообщения
+AUDIT_VALUE_PATHS = [
+    "Event/EventData/Data[@Name='ObjectName']",
+    "Event/EventData/Data[@Name='SubjectUserName']",
+]
+_AUDIT_DATA_RE = re.compile(r"""<Data Name=['"](SubjectUserName|ObjectName)['"]>([^<]*)</Data>""")
+
+# Префикс ISO-времени с точностью до секунды: (секунда, строка)
+_iso_second_cache = (None, '')
+
+def _now_iso() -> str:
+    """Текущее локальное время в формате datetime.isoformat() с микросекундами"""
+    global _iso_second_cache
+    now = time.time()
+    second = int(now)
+    cached = _iso_second_cache
+    if cached[0] != second:
+        # Форматируем дату только при смене секунды
+        cached = (second, time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(second)))
+        _iso_second_cache = cached
+    return f"{cached[1]}.{int((now - second) * 1000000):06d}"
+
+@functools.lru_cache(maxsize=512)
+def _normalize_username_impl(username: str) -> str:
+    """Отбрасывает домен из имени вида DOMAIN\\user (результат кэшируется)"""
+    return username.rsplit('\\', 1)[-1]
+
+class _EditorRecord:
+    """Запись о редакторах файла (__slots__ вместо словаря; время - time.monotonic() в секундах)"""
+    __slots__ = ('primary_editor', 'co_editors', 'last_activity_by_user', 'established_at')
+
+    def __init__(self, primary_editor: str, co_editors: set, last_activity_by_user: Dict[str, float], established_at: float):
+        self.primary_editor = primary_editor
+        self.co_editors = co_editors
+        self.last_activity_by_user = last_activity_by_user
+        self.established_at = established_at
+
+class _OpenFileRecord:
+    """Запись об открытом файле (__slots__ вместо словаря; время - time.monotonic() в секундах)"""
+    __slots__ = ('username', 'processes', 'last_activity', 'last_checked', 'event_type')
+
+    def __init__(self, username: str, processes: list, last_activity: float, last_checked: float, event_type: str):
+        self.username = username
+        self.processes = processes
+        self.last_activity = last_activity
+        self.last_checked = last_checked
+        self.event_type = event_type
+
 class EventHandler:
     def __init__(self, monitoring_config=None):
         if monitoring_config is None:
@@ -38,9 +209,24 @@ class EventHandler:
         self.logger = setup_logger(__name__)
         
         # Инициализация компонентов
-        self.hash_calculator = HashCalculator(self.config.get('hashing', {}))
+        hashing_config = self.config.get('hashing', {})
+        self.hash_calculator = HashCalculator(hashing_config)
+        self.hashing_enabled = bool(hashing_config.get('enabled', True))
         self.session_manager = SessionManager()
         
+        # Пул хеширования: события created/modified и массовое закрытие сессий
+        self._hash_pool = ThreadPoolExecutor(
+            max_workers=hashing_config.get('workers', 4),
+            thread_name_prefix='hash'
+        )
+        # file_path -> последняя задача хеширования или отправки (сохраняет порядок событий файла)
+        self._pending_hashes = {}
+        self._pending_hashes_lock = threading.Lock()
+        # file_path -> ((st_dev, st_ino, st_mtime_ns, st_size), hash): повторное хеширование неизмененного файла пропускается
+        self._hash_cache = OrderedDict()
+        self._hash_cache_lock = threading.Lock()
+        self._hash_cache_size = hashing_config.get('cache_size', 1024)
+        
         # Конфигурация сессий
         session_config = self.config.get('sessions', {})
         self.session_manager.set_config(session_config)
@@ -49,12 +235,20 @@ class EventHandler:
         self.file_validator = FileValidator(self.config)
         
         # Инициализация сервера агента
-        agent_port = self.config.get('agent_server', {}).get('port', 8080)
-        self.agent_server = AgentServer(self, port=agent_port)
+        agent_server_config = self.config.get('agent_server', {})
+        self.agent_server = AgentServer(
+            self,
+            port=agent_server_config.get('port', 8080),
+            threads=agent_server_config.get('threads', 16),
+            connection_limit=agent_server_config.get('connection_limit', 1000)
+        )
         self.agent_server.start()
 
-        # Словарь для отслеживания прокомментированных файлов
-        self.commented_files = {}
+        # Прокомментированные файлы: LRU в порядке добавления, ограничен по размеру и времени жизни
+        self.commented_files = OrderedDict()
+        self.commented_files_max = self.config.get('commented_files_max', 10000)
+        self.commented_files_ttl = timedelta(hours=self.config.get('commented_files_ttl_hours', 168))
+        self._commented_files_lock = threading.Lock()
 
         self.other_agents = self.config.get('agents', [])
 
@@ -64,6 +258,21 @@ class EventHandler:
         self.last_audit_query = datetime.now()
         self.audit_cache = {}  # Кэш для быстрого поиска пользователей
         
+        # Постоянная подписка на журнал Security: читаются только новые записи после закладки,
+        # а последние пользователи по путям складываются в индекс
+        self.audit_bookmark_file = self.config.get('audit_bookmark_file', 'audit_bookmark.xml')
+        self.audit_batch_size = self.config.get('audit_batch_size', 1024)
+        self.audit_index_size = self.config.get('audit_index_size', 10000)
+        self.audit_index_ttl = self.config.get('audit_index_ttl', 300)
+        self._audit_index = OrderedDict()  # путь в нижнем регистре -> (пользователь, time.monotonic())
+        self._audit_lock = threading.Lock()
+        self._audit_subscription = None
+        self._audit_signal = None
+        self._audit_bookmark = None
+        self._audit_render_context = None
+        if self.use_auditing and win32evtlog is not None and win32event is not None:
+            self._open_audit_subscription()
+        
         # Статистика
         self.stats = {
             'events_processed': 0,
@@ -85,45 +294,106 @@ class EventHandler:
         
         # Отслеживание открытых файлов
         self.open_files = {}
+        self._open_files_lock = threading.Lock()
         self.file_renames = {}
         self.file_move_chains = {}
+        # Обратный индекс: путь назначения -> число записей в file_renames/file_move_chains
+        self._move_targets = Counter()
+        # Прямой индекс: исходный путь -> число записей в file_renames/file_move_chains
+        self._move_sources = Counter()
         self.temp_to_main_map = {}
+        self._main_to_temp_map = {}  # обратный индекс: основной файл -> множество временных
         self.main_file_tracking = {}
         
         # Трекер операций
         self.office_creation_operations = {}
         self.pending_office_operations = {}
         self.cad_temp_files = {}
+        # Каталог -> имена CAD файлов в нем (заполняется одним os.scandir, далее ведется по событиям)
+        self._cad_files_by_dir: Dict[str, set] = {}
         
         # Многопользовательская работа
-        self.file_editors = {}
+        self.file_editors: Dict[str, _EditorRecord] = {}
         self.user_file_locks = {}
         
-        # Время последней проверки
-        self.last_open_files_check = datetime.now()
+        # Время последней проверки; времена открытых файлов - в секундах time.monotonic()
+        self.last_open_files_check = time.monotonic()
+        self.open_files_check_interval = 30.0
+        self.open_file_close_delay = 5.0
         
-        # Фильтр массовых событий
-        self.recent_events = {}
+        # Фильтр массовых событий: (путь, тип) -> time.monotonic(), в порядке времени
+        self.recent_events = OrderedDict()
+        self.recent_events_max = self.config.get('recent_events_max', 20000)
         self.event_cooldown = 2.0
         
         # Трекер реально открытых файлов
         self.verified_open_files = set()
         
+        # Индекс открытых файлов (путь -> процессы), переиспользуется в пределах TTL
+        self._watch_roots = frozenset(_open_file_key(path) for path in self.config.get('watch_paths', []))
+        # Префиксы с разделителем: корень /data не должен захватывать /database
+        self._watch_root_prefixes = tuple(root.rstrip(os.sep) + os.sep for root in self._watch_roots)
+        self.open_files_index_ttl = self.config.get('open_files_index_ttl', 1.0)
+        self._open_files_index = None
+        self._open_files_index_ts = 0.0
+        self._open_files_index_lock = threading.Lock()
+        
+        # Фоновое обновление индекса: обработчики событий не ждут обхода процессов (0 - отключено)
+        self.open_files_refresh_interval = self.config.get('open_files_refresh_interval', 5.0)
+        self._open_files_refresh_stop = threading.Event()
+        self._open_files_refresher = None
+        if psutil and self.open_files_refresh_interval > 0:
+            # Синхронная пересборка - только если фоновый поток отстал
+            self.open_files_index_ttl = max(self.open_files_index_ttl, 2 * self.open_files_refresh_interval)
+            self._open_files_refresher = threading.Thread(
+                target=self._open_files_refresh_loop, name='open-files-index', daemon=True
+            )
+            self._open_files_refresher.start()
+        
+        # Пауза перед обработкой создания Office файла (отсеивает временные файлы сохранения)
+        self.office_creation_delay = self.config.get('office_creation_delay', 0.5)
+        # file_path -> (таймер, username) отложенных созданий; лок сериализует завершение создания
+        # с последующими событиями того же файла
+        self._office_creation_timers = {}
+        self._office_creation_lock = threading.Lock()
+        
+        # Таблица обработчиков событий основных файлов: один поиск в словаре вместо цепочки сравнений
+        self._main_file_handlers = {
+            'created': self._handle_file_created,
+            'modified': self._handle_file_modified,
+            'deleted': self._handle_file_deleted,
+        }
+        
         self.logger.info(f"EventHandler initialized with auditing={self.use_auditing}")
 
     
     
     def handle_file_event(self, event_type: str, file_path: str, dest_path: str = None) -> bool:
         """Обрабатывает событие файла с поддержкой аудита"""
+        # Один объект строки пути на все словари отслеживания (ключи сравниваются по идентичности)
+        file_path = sys.intern(file_path)
+        if dest_path:
+            dest_path = sys.intern(dest_path)
         try:
+            # Отложенное создание Office файла завершается раньше любого следующего события этого файла
+            if file_path in self._office_creation_timers:
+                self._flush_office_creation(file_path)
+            if dest_path and dest_path in self._office_creation_timers:
+                self._flush_office_creation(dest_path)
+            
+            self._update_cad_files_index(event_type, file_path, dest_path)
+            # Изменение при грубом разрешении mtime может не сдвинуть ключ кэша
+            if event_type == 'modified':
+                self._invalidate_hash(file_path)
+            
             # Фильтр частых событий
             if not self._should_process_event(file_path, event_type):
-                self.logger.debug(f"⏰ Skipping frequent event: {event_type} for {file_path}")
+                self.logger.debug("⏰ Skipping frequent event: %s for %s", event_type, file_path)
                 return True
                 
             self.stats['events_processed'] += 1
             
-            self.logger.debug(f"Raw event: {event_type} - {file_path} -> {dest_path}")
+            self.logger.debug("Raw event: %s - %s -> %s", event_type, file_path, dest_path)
             
             # Определяем категорию файла ДО обработки
             file_category = self.file_validator.get_file_category(file_path)
@@ -134,13 +404,13 @@ class EventHandler:
             
             # Для IGNORE файлов - полностью пропускаем обработку
             if file_category == 'IGNORE':
-                self.logger.debug(f"🚫 Completely ignoring event for IGNORE file: {file_path}")
+                self.logger.debug("🚫 Completely ignoring event for IGNORE file: %s", file_path)
                 return True
             
             # Для TEMPORARY файлов - обрабатываем для контекста, но не создаем сессии
             if file_category == 'TEMPORARY':
                 self.stats['temporary_files_ignored'] += 1
-                self.logger.debug(f"⏰ Processing temporary file for context: {file_path}")
+                self.logger.debug("⏰ Processing temporary file for context: %s", file_path)
                 return self._handle_temporary_file(event_type, file_path, dest_path)
             
             # Для MAIN файлов - полная обработка с сессиями
@@ -159,14 +429,14 @@ class EventHandler:
     def _handle_main_file(self, event_type: str, file_path: str) -> bool:
         """Обрабатывает событие для основного файла с поддержкой аудита"""
         if not self.file_validator.should_monitor_file(file_path):
-            self.logger.debug(f"Ignoring main file: {file_path}")
+            self.logger.debug("Ignoring main file: %s", file_path)
             return True
         
         # Получаем пользователя через аудит или fallback методы
         username = self._get_file_modifier_safe(file_path, event_type)
         normalized_username = self._normalize_username(username)
         
-        self.logger.debug(f"Main file event: {event_type} - {file_path} by {normalized_username}")
+        self.logger.debug("Main file event: %s - %s by %s", event_type, file_path, normalized_username)
         
         # Получаем текущих редакторов
         current_editors = self._get_current_editors(file_path)
@@ -177,38 +447,34 @@ class EventHandler:
             self.stats['multi_user_sessions'] += 1
         
         # Проверяем является ли это частью Office операции создания
-        if event_type == 'created' and self._is_office_creation_operation(file_path):
+        if event_type == 'created' and _is_office_creation_operation(file_path):
             self.logger.info(f"🔄 Detected Office file creation operation: {file_path}")
             return self._handle_office_file_creation(file_path, normalized_username)
         
         # Проверяем является ли это частью CAD операции
-        if event_type == 'created' and self._is_cad_operation(file_path):
+        if event_type == 'created' and _is_cad_operation(file_path):
             self.logger.info(f"🔄 Detected CAD file operation: {file_path}")
             return self._handle_cad_file_operation(file_path, normalized_username, event_type)
         
         # Обрабатываем в зависимости от типа события
-        if event_type == 'created':
-            return self._handle_file_created(file_path, normalized_username, current_editors)
-        elif event_type == 'modified':
-            return self._handle_file_modified(file_path, normalized_username, current_editors)
-        elif event_type == 'deleted':
-            return self._handle_file_deleted(file_path, normalized_username, current_editors)
-        else:
+        handler = self._main_file_handlers.get(event_type)
+        if handler is None:
             self.logger.warning(f"Unknown event type for main file: {event_type}")
             return False
+        return handler(file_path, normalized_username, current_editors)
 
     def _get_file_modifier_safe(self, file_path: str, event_type: str) -> str:
         """Безопасное получение модификатора файла с приоритетом по процессам"""
         try:
-            if not os.path.exists(file_path) and event_type != 'deleted':
-                return getpass.getuser()
+            if event_type != 'deleted' and not os.path.exists(file_path):
+                return _CURRENT_USER
         
             # ПЕРВЫЙ ПРИОРИТЕТ: Получаем пользователя из процессов, работающих с файлом
             current_editors = self._get_current_editors(file_path)
             if current_editors:
                 # Берем первого редактора (самого активного)
                 primary_editor = current_editors[0]
-                self.logger.debug(f"👤 Determined editor from processes: {primary_editor} for {file_path}")
+                self.logger.debug("👤 Determined editor from processes: %s for %s", primary_editor, file_path)
                 return primary_editor
         
             # ВТОРОЙ ПРИОРИТЕТ: Пытаемся получить пользователя через аудит
@@ -216,68 +482,174 @@ class EventHandler:
                 audit_user = self._get_user_from_audit_log(file_path)
                 if audit_user:
                     self.stats['audit_events_used'] += 1
-                    self.logger.debug(f"👤 Determined editor from audit: {audit_user} for {file_path}")
+                    self.logger.debug("👤 Determined editor from audit: %s for %s", audit_user, file_path)
                     return audit_user
         
             # ТРЕТИЙ ПРИОРИТЕТ: получаем владельца файла
             file_owner = self._get_file_modifier(file_path)
-            self.logger.debug(f"👤 Determined editor from file owner: {file_owner} for {file_path}")
+            self.logger.debug("👤 Determined editor from file owner: %s for %s", file_owner, file_path)
             return file_owner
             
         except Exception as e:
             self.logger.warning(f"Failed to get file modifier for {file_path}, using current user: {e}")
-            return getpass.getuser()
+            return _CURRENT_USER
 
+    def _open_audit_subscription(self):
+        """Открывает pull-подписку на события доступа к файлам в журнале Security"""
+        bookmark_xml = None
+        try:
+            if os.path.exists(self.audit_bookmark_file):
+                with open(self.audit_bookmark_file, encoding='utf-8') as f:
+                    bookmark_xml = f.read().strip() or None
+        except OSError as e:
+            self.logger.warning(f"⚠️ Cannot read audit bookmark {self.audit_bookmark_file}: {e}")
+        
+        try:
+            self._audit_bookmark = win32evtlog.EvtCreateBookmark(bookmark_xml)
+            self._audit_signal = win32event.CreateEvent(None, 0, 0, None)
+            if bookmark_xml:
+                # Продолжаем с места остановки, не перечитывая уже обработанные записи
+                self._audit_subscription = win32evtlog.EvtSubscribe(
+                    'Security',
+                    win32evtlog.EvtSubscribeStartAfterBookmark,
+                    SignalEvent=self._audit_signal,
+                    Query=AUDIT_EVENTS_QUERY,
+                    Bookmark=self._audit_bookmark
+                )
+            else:
+                self._audit_subscription = win32evtlog.EvtSubscribe(
+                    'Security',
+                    win32evtlog.EvtSubscribeToFutureEvents,
+                    SignalEvent=self._audit_signal,
+                    Query=AUDIT_EVENTS_QUERY
+                )
+            self.logger.info("📜 Subscribed to Security log file access events")
+        except Exception as e:
+            self._audit_subscription = None
+            self.logger.warning(f"⚠️ Cannot subscribe to Security log, using full log reads: {e}")
+            return
+        
+        try:
+            self._audit_render_context = win32evtlog.EvtCreateRenderContext(
+                win32evtlog.EvtRenderContextValues, AUDIT_VALUE_PATHS
+            )
+        except Exception as e:
+            # Старые версии pywin32 не поддерживают ValuePaths - рендерим XML
+            self._audit_render_context = None
+            self.logger.debug("Audit value render context unavailable, using XML rendering: %s", e)
+    
+    def _render_audit_fields(self, event) -> tuple:
+        """Возвращает (ObjectName, SubjectUserName) события"""
+        if self._audit_render_context is not None:
+            values = win32evtlog.EvtRender(event, win32evtlog.EvtRenderEventValues, Context=self._audit_render_context)
+            return values[0][0], values[1][0]
+        
+        fields = dict(_AUDIT_DATA_RE.findall(win32evtlog.EvtRender(event, win32evtlog.EvtRenderEventXml)))
+        obj_name = fields.get('ObjectName')
+        return (html.unescape(obj_name) if obj_name else None), fields.get('SubjectUserName')
+    
+    def _drain_audit_subscription(self):
+        """Забирает новые события из подписки в индекс путь -> пользователь (вызывать под _audit_lock)"""
+        now = time.monotonic()
+        last_event = None
+        
+        while True:
+            events = win32evtlog.EvtNext(self._audit_subscription, self.audit_batch_size, 0)
+            if not events:
+                break
+            
+            for event in events:
+                obj_name, user = self._render_audit_fields(event)
+                if not obj_name or not user or user == "SYSTEM":
+                    continue
+                
+                # События приходят по возрастанию - более позднее перезаписывает раннее
+                key = _normalize_path(obj_name)
+                self._audit_index[key] = (user, now)
+                self._audit_index.move_to_end(key)
+            last_event = events[-1]
+        
+        if last_event is not None:
+            win32evtlog.EvtUpdateBookmark(self._audit_bookmark, last_event)
+            while len(self._audit_index) > self.audit_index_size:
+                self._audit_index.popitem(last=False)
+    
+    def _save_audit_bookmark(self):
+        """Сохраняет закладку подписки, чтобы после перезапуска не перечитывать журнал"""
+        if self._audit_subscription is None:
+            return
+        tmp_file = f"{self.audit_bookmark_file}.tmp"
+        try:
+            with self._audit_lock:
+                bookmark_xml = win32evtlog.EvtRender(self._audit_bookmark, win32evtlog.EvtRenderBookmark)
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(bookmark_xml)
+            os.replace(tmp_file, self.audit_bookmark_file)
+        except Exception as e:
+            self.logger.error(f"Failed to save audit bookmark: {e}")
+    
     def _get_user_from_audit_log(self, file_path: str) -> Optional[str]:
         """Получает пользователя из Windows Security Event Log"""
+        if self._audit_subscription is not None:
+            try:
+                with self._audit_lock:
+                    self._drain_audit_subscription()
+                    entry = self._audit_index.get(_normalize_path(file_path))
+                if entry and time.monotonic() - entry[1] < self.audit_index_ttl:
+                    self.logger.debug("Found user in audit index: %s for %s", entry[0], file_path)
+                    return entry[0]
+                return None
+            except Exception as e:
+                self.stats['audit_errors'] += 1
+                self.logger.error(f"Error reading audit subscription: {e}")
+                return None
+        
         try:
-            current_time = datetime.now()
+            current_time = time.monotonic()
             
             # Используем кэш для быстрого поиска
             if file_path in self.audit_cache:
                 cached_data = self.audit_cache[file_path]
-                if (current_time - cached_data['timestamp']).total_seconds() < 30:  # Кэш на 30 секунд
+                if current_time - cached_data['timestamp'] < 30:  # Кэш на 30 секунд
                     return cached_data['username']
             
             # Опрашиваем Event Log
             handle = win32evtlog.OpenEventLog(None, "Security")
             flags = win32evtlog.EVENTLOG_BACKWARDS_READ | win32evtlog.EVENTLOG_SEQUENTIAL_READ
             
-            events = win32evtlog.ReadEventLog(handle, flags, 0)
-            target_events = []
+            try:
+                events = win32evtlog.ReadEventLog(handle, flags, 0)
+            finally:
+                win32evtlog.CloseEventLog(handle)
+            file_path_lower = file_path.lower()
+            latest_time = None
+            username = None
             
             for event in events:
                 # Интересуют нас события доступа к файлам
-                if event.EventID in [4663, 4656, 4670]:  # File access events
+                if event.EventID in AUDIT_EVENT_IDS:  # File access events
                     try:
                         # Получаем путь к файлу из события
                         obj_name = win32evtlogutil.SafeGetEventString(event, 6)  # Object Name
-                        if obj_name and file_path.lower() in obj_name.lower():
+                        if obj_name and file_path_lower in obj_name.lower():
                             # Получаем имя пользователя
                             user = win32evtlogutil.SafeGetEventString(event, 1)  # Subject User Name
-                            if user and user != "SYSTEM":
-                                target_events.append({
-                                    'timestamp': event.TimeGenerated,
-                                    'username': user,
-                                    'event_id': event.EventID
-                                })
+                            # Запоминаем только самое последнее событие
+                            if user and user != "SYSTEM" and (latest_time is None or event.TimeGenerated > latest_time):
+                                latest_time = event.TimeGenerated
+                                username = user
                     except Exception as e:
                         continue
             
-            win32evtlog.CloseEventLog(handle)
             
-            if target_events:
-                # Берем самое последнее событие
-                latest_event = max(target_events, key=lambda x: x['timestamp'])
-                username = latest_event['username']
-                
+            if username:
                 # Сохраняем в кэш
                 self.audit_cache[file_path] = {
                     'username': username,
                     'timestamp': current_time
                 }
                 
-                self.logger.debug(f"Found user in audit log: {username} for {file_path}")
+                self.logger.debug("Found user in audit log: %s for %s", username, file_path)
                 return username
             
         except Exception as e:
@@ -289,16 +661,19 @@ class EventHandler:
     def _get_file_modifier(self, file_path: str) -> str:
         """Получает владельца файла"""
         try:
-            if platform.system() == 'Windows' and win32security is not None:
+            if _IS_WINDOWS and win32security is not None:
                 sd = win32security.GetFileSecurity(file_path, win32security.OWNER_SECURITY_INFORMATION)
                 owner_sid = sd.GetSecurityDescriptorOwner()
-                name, domain, _ = win32security.LookupAccountSid(None, owner_sid)
-                return f"{domain}\\{name}"
+                owner = _lookup_account_name(win32security.ConvertSidToStringSid(owner_sid))
+                if owner is not None:
+                    return owner
+                self.logger.debug("Owner SID of %s cannot be resolved, using current user", file_path)
+                return _CURRENT_USER
             else:
-                return getpass.getuser()
+                return _CURRENT_USER
         except Exception as e:
             self.logger.error(f"Failed to get file owner for {file_path}: {e}")
-            return getpass.getuser()
+            return _CURRENT_USER
 
     # def _get_current_editors(self, file_path: str) -> List[str]:
     #     """Возвращает список пользователей, которые сейчас работают с файлом - УЛУЧШЕННАЯ ВЕРСИЯ"""
@@ -375,12 +750,10 @@ class EventHandler:
                 self.logger.info(f"🔍 Found ACTIVE editors via processes for {file_path}: {editors_list}")
             
                 # ОБНОВЛЯЕМ кэш редакторов
-                self.file_editors[file_path] = {
-                    'primary_editor': editors_list[0],
-                    'co_editors': set(editors_list[1:]) if len(editors_list) > 1 else set(),
-                    'last_activity_by_user': {editor: datetime.now() for editor in editors_list},
-                    'established_at': datetime.now()
-                }
+                now = time.monotonic()
+                self.file_editors[file_path] = _EditorRecord(
+                    editors_list[0], set(editors_list[1:]), dict.fromkeys(editors_list, now), now
+                )
                 return editors_list
     
             # ЕСЛИ ПРОЦЕССОВ НЕ НАЙДЕНО - ОЧИЩАЕМ КЭШ РЕДАКТОРОВ
@@ -389,7 +762,7 @@ class EventHandler:
                 del self.file_editors[file_path]
             
         except Exception as e:
-            self.logger.debug(f"Error getting current editors for {file_path}: {e}")
+            self.logger.debug("Error getting current editors for %s: %s", file_path, e)
             # При ошибке также очищаем кэш
             if file_path in self.file_editors:
                 del self.file_editors[file_path]
@@ -406,24 +779,23 @@ class EventHandler:
             self.logger.info(f"👑 Primary editor from ACTIVE processes: {primary_editor} for {file_path}")
     
             # ОБНОВЛЯЕМ информацию о редакторах
-            self.file_editors[file_path] = {
-                'primary_editor': primary_editor,
-                'co_editors': set(all_editors[1:]),
-                'last_activity_by_user': {editor: datetime.now() for editor in all_editors},
-                'established_at': datetime.now()
-            }
+            now = time.monotonic()
+            self.file_editors[file_path] = _EditorRecord(
+                primary_editor, set(all_editors[1:]), dict.fromkeys(all_editors, now), now
+            )
             return primary_editor
 
         # ПРИОРИТЕТ 2: Если нет реальных процессов, НЕ используем кэш - определяем заново
         self.logger.info(f"👑 Using CURRENT user (no active processes): {current_username} for {file_path}")
 
+        # Запись того же пользователя без со-редакторов уже совпадает с новой - не пересоздаем
+        editor_info = self.file_editors.get(file_path)
+        if editor_info is not None and editor_info.primary_editor == current_username and not editor_info.co_editors:
+            return current_username
+
         # СОЗДАЕМ НОВУЮ запись вместо использования старого кэша
-        self.file_editors[file_path] = {
-            'primary_editor': current_username,
-            'co_editors': set(),
-            'last_activity_by_user': {current_username: datetime.now()},
-            'established_at': datetime.now()
-        }
+        now = time.monotonic()
+        self.file_editors[file_path] = _EditorRecord(current_username, set(), {current_username: now}, now)
 
         return current_username
     
@@ -436,8 +808,8 @@ class EventHandler:
                 # Создаем новую сессию вместо возобновления старой
                 return self._create_new_session_for_commented_file(file_path, username, current_editors)
             
-            if file_path in self.file_renames.values() or file_path in self.file_move_chains.values():
-                self.logger.debug(f"Ignoring created event for moved file: {file_path}")
+            if file_path in self._move_targets:
+                self.logger.debug("Ignoring created event for moved file: %s", file_path)
                 return True
             
             self.logger.info(f"📄 Main file created: {file_path} by {username}")
@@ -445,18 +817,14 @@ class EventHandler:
             # Определяем основного редактора
             primary_editor = self._determine_primary_editor(file_path, username, current_editors)
         
-            # Вычисляем хеш если нужно
-            file_hash = None
-            if (self.config.get('hashing', {}).get('enabled', True) and
-                os.path.exists(file_path)):
-                file_hash = self.hash_calculator.calculate_file_hash_with_retry(file_path)
-        
-            # Создаем сессию с основным редактором
-            session_data = self.session_manager.smart_create_session(file_path, primary_editor, file_hash)
+            # Создаем сессию с основным редактором (хеш вычисляется в пуле)
+            session_data = self.session_manager.smart_create_session(file_path, primary_editor)
         
             # Добавляем информацию о со-редакторах в сессию
-            if len(current_editors) > 1:
-                session_data['co_editors'] = [editor for editor in current_editors if editor != primary_editor]
+            co_editors = [editor for editor in current_editors if editor != primary_editor]
+            is_multi_user = len(current_editors) > 1
+            if is_multi_user:
+                session_data['co_editors'] = co_editors
                 session_data['is_multi_user'] = True
                 self.logger.info(f"👥 Multi-user session created for {file_path}. Primary: {primary_editor}, Co-editors: {session_data['co_editors']}")
         
@@ -466,28 +834,13 @@ class EventHandler:
             else:
                 self.stats['sessions_created'] += 1
         
-            event_data = {
-                'file_path': file_path,
-                'file_name': os.path.basename(file_path),
-                'event_type': 'created',
-                'file_hash': file_hash,
-                'user_id': primary_editor,
-                'session_id': session_data['session_id'],
-                'resume_count': session_data.get('resume_count', 0),
-                'is_multi_user': len(current_editors) > 1,
-                'co_editors': [editor for editor in current_editors if editor != primary_editor],
-                'source': 'server_agent',
-                'event_timestamp': datetime.now().isoformat()
-            }
+            event_data = self._build_event_data(file_path, 'created', session_data, primary_editor, current_editors, co_editors=co_editors)
         
-            success = self.api_client.send_event(event_data)
-            if not success:
-                self.logger.error(f"Failed to send created event for {file_path}: {event_data}")
-            return success    
+            return self._send_event_hashed(event_data, session_data, f"Failed to send created event for {file_path}: {event_data}")
 
     def _handle_file_modified(self, file_path: str, username: str, current_editors: List[str]) -> bool:
         """Обрабатывает изменение файла с поддержкой многопользовательской работы"""
-        self.logger.debug(f"📝 Main file modified: {file_path} by {username}")
+        self.logger.debug("📝 Main file modified: %s by %s", file_path, username)
     
         # Проверяем можно ли возобновить сессию
         if not self.session_manager.can_resume_session(file_path, username):
@@ -498,44 +851,25 @@ class EventHandler:
         # Определяем основного редактора
         primary_editor = self._determine_primary_editor(file_path, username, current_editors)
     
-        # Вычисляем хеш если нужно
-        file_hash = None
-        if (self.config.get('hashing', {}).get('enabled', True) and
-            os.path.exists(file_path)):
-            file_hash = self.hash_calculator.calculate_file_hash_with_retry(file_path)
-    
-        # Обновляем сессию с основным редактором
-        session_data = self.session_manager.smart_create_session(file_path, primary_editor, file_hash)
+        # Обновляем сессию с основным редактором (хеш вычисляется в пуле)
+        session_data = self.session_manager.smart_create_session(file_path, primary_editor)
 
         # ДОБАВЛЕНО: Обновляем информацию о со-редакторах
-        if len(current_editors) > 1:
-            session_data['co_editors'] = [editor for editor in current_editors if editor != primary_editor]
+        co_editors = [editor for editor in current_editors if editor != primary_editor]
+        is_multi_user = len(current_editors) > 1
+        if is_multi_user:
+            session_data['co_editors'] = co_editors
             session_data['is_multi_user'] = True
     
-        event_data = {
-            'file_path': file_path,
-            'file_name': os.path.basename(file_path),
-            'event_type': 'modified',
-            'file_hash': file_hash,
-            'user_id': primary_editor,
-            'session_id': session_data['session_id'],
-            'resume_count': session_data.get('resume_count', 0),
-            'is_multi_user': len(current_editors) > 1,
-            'co_editors': [editor for editor in current_editors if editor != primary_editor],
-            'source': 'server_agent',
-            'event_timestamp': datetime.now().isoformat()
-        }
+        event_data = self._build_event_data(file_path, 'modified', session_data, primary_editor, current_editors, co_editors=co_editors)
     
-        success = self.api_client.send_event(event_data)
-        if not success:
-            self.logger.error(f"Failed to send modified event for {file_path}: {event_data}")
-        return success
+        return self._send_event_hashed(event_data, session_data, f"Failed to send modified event for {file_path}: {event_data}")
     
     
     def _handle_file_deleted(self, file_path: str, username: str, current_editors: List[str]) -> bool:
         """Обрабатывает удаление файла с поддержкой многопользовательской работы"""
-        if file_path in self.file_renames or file_path in self.file_move_chains:
-            self.logger.debug(f"📦 File moved, closing session for: {file_path}")
+        if file_path in self._move_sources:
+            self.logger.debug("📦 File moved, closing session for: %s", file_path)
             
             # Определяем основного редактора для закрытия сессии
             primary_editor = self._determine_primary_editor(file_path, username, current_editors)
@@ -543,10 +877,8 @@ class EventHandler:
             
             if session_data:
                 self.logger.info(f"✅ Closed session for moved file: {file_path}")
-            if file_path in self.file_renames:
-                del self.file_renames[file_path]
-            if file_path in self.file_move_chains:
-                del self.file_move_chains[file_path]
+            self._forget_move(self.file_renames, file_path)
+            self._forget_move(self.file_move_chains, file_path)
             return True
             
         self.logger.info(f"🗑️ Main file deleted: {file_path} by {username}")
@@ -555,25 +887,19 @@ class EventHandler:
         # Определяем основного редактора для закрытия сессии
         primary_editor = self._determine_primary_editor(file_path, username, current_editors)
         
-        if file_path in self.open_files:
-            del self.open_files[file_path]
+        with self._open_files_lock:
+            self.open_files.pop(file_path, None)
         
-        if file_path in self.file_renames:
-            del self.file_renames[file_path]
-        if file_path in self.file_move_chains:
-            del self.file_move_chains[file_path]
+        self._forget_move(self.file_renames, file_path)
+        self._forget_move(self.file_move_chains, file_path)
         
         if file_path in self.verified_open_files:
             self.verified_open_files.remove(file_path)
         
-        # Очищаем из temp_to_main_map
-        keys_to_remove = []
-        for temp_path, main_path in self.temp_to_main_map.items():
-            if temp_path == file_path or main_path == file_path:
-                keys_to_remove.append(temp_path)
-        
-        for key in keys_to_remove:
-            del self.temp_to_main_map[key]
+        # Очищаем из temp_to_main_map (по обратному индексу, без обхода всего словаря)
+        for temp_path in tuple(self._main_to_temp_map.get(file_path, ())):
+            self._unmap_temp_file(temp_path)
+        self._unmap_temp_file(file_path)
             
         # Очищаем из main_file_tracking
         if file_path in self.main_file_tracking:
@@ -601,20 +927,9 @@ class EventHandler:
         
         if session_data:
             self.logger.info(f"✅ Successfully closed session for deleted file: {file_path}")
-            event_data = {
-                'file_path': file_path,
-                'file_name': os.path.basename(file_path),
-                'event_type': 'deleted',
-                'user_id': primary_editor,
-                'session_id': session_data['session_id'],
-                'resume_count': session_data.get('resume_count', 0),
-                'is_multi_user': len(current_editors) > 1,
-                'co_editors': [editor for editor in current_editors if editor != primary_editor],
-                'source': 'server_agent',
-                'event_timestamp': datetime.now().isoformat()
-            }
+            event_data = self._build_event_data(file_path, 'deleted', session_data, primary_editor, current_editors)
             
-            success = self.api_client.send_event(event_data)
+            success = self._send_event_ordered(event_data)
             if not success:
                 self.logger.error(f"❌ Failed to send deleted event for: {file_path}")
             return success
@@ -622,14 +937,14 @@ class EventHandler:
             self.logger.warning(f"⚠️ No session found for deleted file: {file_path}")
             event_data = {
                 'file_path': file_path,
-                'file_name': os.path.basename(file_path),
+                'file_name': _file_name(file_path),
                 'event_type': 'deleted',
                 'user_id': username,
                 'source': 'server_agent',
-                'event_timestamp': datetime.now().isoformat()
+                'event_timestamp': _now_iso()
             }
             
-            success = self.api_client.send_event(event_data)
+            success = self._send_event_ordered(event_data)
             return success
 
     def _handle_file_moved(self, src_path: str, dest_path: str, src_category: str) -> bool:
@@ -637,7 +952,7 @@ class EventHandler:
         self.logger.info(f"🔄 File moved: {src_path} -> {dest_path} (src category: {src_category})")
         
         dest_category = self.file_validator.get_file_category(dest_path)
-        self.logger.debug(f"Destination category: {dest_category}")
+        self.logger.debug("Destination category: %s", dest_category)
         
         # ДОБАВЛЕНО: Переносим информацию о редакторах
         if src_path in self.file_editors:
@@ -647,24 +962,24 @@ class EventHandler:
         
         # Специальная обработка для Office операций переименования
         if (src_category == 'MAIN' and dest_category == 'MAIN' and 
-            self._is_office_creation_operation(src_path)):
+            _is_office_creation_operation(src_path)):
             self.logger.info(f"📝 Office file rename operation: {src_path} -> {dest_path}")
             return self._handle_office_file_rename(src_path, dest_path)
         
         # Определяем тип операции
         operation_type = self._classify_move_operation(src_path, dest_path, src_category, dest_category)
-        self.logger.debug(f"Move operation type: {operation_type}")
+        self.logger.debug("Move operation type: %s", operation_type)
         
         if operation_type == 'TEMP_TO_TEMP':
-            self.file_move_chains[src_path] = dest_path
-            self.logger.debug(f"Temp-to-temp move: {src_path} -> {dest_path}")
+            self._record_move(self.file_move_chains, src_path, dest_path)
+            self.logger.debug("Temp-to-temp move: %s -> %s", src_path, dest_path)
             return True
             
         elif operation_type == 'MAIN_TO_TEMP':
-            self.temp_to_main_map[dest_path] = src_path
-            self.logger.debug(f"Main-to-temp move: {src_path} -> {dest_path}")
+            self._map_temp_file(dest_path, src_path)
+            self.logger.debug("Main-to-temp move: %s -> %s", src_path, dest_path)
             self.main_file_tracking[src_path] = {
-                'last_seen': datetime.now(),
+                'last_seen': time.monotonic(),
                 'temp_file': dest_path
             }
             return True
@@ -676,7 +991,7 @@ class EventHandler:
             return self._handle_main_to_main_move(src_path, dest_path)
             
         elif operation_type == 'TEMP_TO_IGNORE':
-            self.logger.debug(f"Temp-to-ignore move (Excel operation): {src_path} -> {dest_path}")
+            self.logger.debug("Temp-to-ignore move (Excel operation): %s -> %s", src_path, dest_path)
             return True
             
         elif operation_type == 'IGNORE_TO_MAIN':
@@ -696,8 +1011,8 @@ class EventHandler:
         primary_editor = self._determine_primary_editor(dest_path, normalized_username, current_editors)
         
         file_hash = None
-        if self.config.get('hashing', {}).get('enabled', True):
-            file_hash = self.hash_calculator.calculate_file_hash_with_retry(dest_path)
+        if self.hashing_enabled:
+            file_hash = self._cached_hash(dest_path)
         
         # Переносим существующую сессию
         old_session = self.session_manager.get_active_session(src_path, primary_editor)
@@ -719,11 +1034,70 @@ class EventHandler:
             self.logger.info(f"✅ Created new session for renamed Office file: {dest_path}")
         
         # Сохраняем информацию о перемещении
-        self.file_renames[src_path] = dest_path
-        self.file_move_chains[src_path] = dest_path
+        self._record_move(self.file_renames, src_path, dest_path)
+        self._record_move(self.file_move_chains, src_path, dest_path)
         
         return self._send_moved_event(src_path, dest_path, primary_editor, file_hash, current_editors)
 
+    def _map_temp_file(self, temp_path: str, main_path: str):
+        """Связывает временный файл с основным и обновляет обратный индекс"""
+        self._unmap_temp_file(temp_path)
+        self.temp_to_main_map[temp_path] = main_path
+        self._main_to_temp_map.setdefault(main_path, set()).add(temp_path)
+
+    def _unmap_temp_file(self, temp_path: str):
+        """Удаляет связь временного файла с основным и обновляет обратный индекс"""
+        main_path = self.temp_to_main_map.pop(temp_path, None)
+        if main_path is None:
+            return
+        temp_paths = self._main_to_temp_map.get(main_path)
+        if temp_paths is not None:
+            temp_paths.discard(temp_path)
+            if not temp_paths:
+                del self._main_to_temp_map[main_path]
+
+    def _record_move(self, moves: dict, src_path: str, dest_path: str):
+        """Запоминает перемещение src -> dest и обновляет индексы путей"""
+        self._forget_move(moves, src_path)
+        moves[src_path] = dest_path
+        self._move_sources[src_path] += 1
+        self._move_targets[dest_path] += 1
+
+    def _forget_move(self, moves: dict, src_path: str):
+        """Удаляет запись о перемещении src и обновляет индексы путей"""
+        dest_path = moves.pop(src_path, None)
+        if dest_path is None:
+            return
+        self._move_sources[src_path] -= 1
+        if self._move_sources[src_path] <= 0:
+            del self._move_sources[src_path]
+        self._move_targets[dest_path] -= 1
+        if self._move_targets[dest_path] <= 0:
+            del self._move_targets[dest_path]
+
+    def _build_event_data(self, file_path: str, event_type: str, session_data: Dict, primary_editor: str,
+                          current_editors: List[str], file_hash: Optional[str] = None, co_editors: List[str] = None,
+                          event_timestamp: str = None, **extras) -> Dict[str, Any]:
+        """Собирает событие сессии из общих полей; extras добавляет флаги конкретного обработчика"""
+        if co_editors is None:
+            co_editors = [editor for editor in current_editors if editor != primary_editor]
+        event_data = {
+            'file_path': file_path,
+            'file_name': _file_name(file_path),
+            'event_type': event_type,
+            'file_hash': file_hash,
+            'user_id': primary_editor,
+            'session_id': session_data['session_id'],
+            'resume_count': session_data.get('resume_count', 0),
+            'is_multi_user': len(current_editors) > 1,
+            'co_editors': co_editors,
+            'source': 'server_agent',
+            'event_timestamp': event_timestamp or _now_iso()
+        }
+        if extras:
+            event_data.update(extras)
+        return event_data
+
     def _send_moved_event(self, src_path: str, dest_path: str, username: str, file_hash: str, current_editors: List[str] = None) -> bool:
         """Отправляет событие перемещения с поддержкой многопользовательской работы"""
         if current_editors is None:
@@ -734,95 +1108,127 @@ class EventHandler:
         
         event_data = {
             'file_path': dest_path,
-            'file_name': os.path.basename(dest_path),
+            'file_name': _file_name(dest_path),
             'old_file_path': src_path,
-            'old_file_name': os.path.basename(src_path),
+            'old_file_name': _file_name(src_path),
             'event_type': 'moved',
             'file_hash': file_hash,
             'user_id': primary_editor,
             'is_multi_user': is_multi_user,
             'co_editors': [editor for editor in current_editors if editor != primary_editor] if is_multi_user else [],
             'source': 'server_agent',
-            'event_timestamp': datetime.now().isoformat()
+            'event_timestamp': _now_iso()
         }
         
-        success = self.api_client.send_event(event_data)
+        # Событие перемещения встает за задачами и исходного пути, и пути назначения
+        success = self._send_event_ordered(event_data, (src_path, dest_path))
         if not success:
             self.logger.error(f"Failed to send moved event for {src_path} -> {dest_path}")
         return success
 
     def _handle_temporary_file(self, event_type: str, file_path: str, dest_path: str = None) -> bool:
         """Обрабатывает событие для временного файла (без создания сессий)"""
-        self.logger.debug(f"Temporary file event: {event_type} - {file_path}")
+        self.logger.debug("Temporary file event: %s - %s", event_type, file_path)
         
-        if self._is_office_temp_file(file_path):
-            self.logger.debug(f"🔍 Office temporary file detected: {file_path}")
+        if _is_office_temp_file(file_path):
+            self.logger.debug("🔍 Office temporary file detected: %s", file_path)
             self._track_office_temp_file(file_path)
         
-        if self._is_cad_temp_file(file_path):
-            self.logger.debug(f"🔍 CAD temporary file detected: {file_path}")
+        if _is_cad_temp_file(file_path):
+            self.logger.debug("🔍 CAD temporary file detected: %s", file_path)
             self._track_cad_temp_file(file_path)
         
         if event_type == 'moved' and dest_path:
             dest_category = self.file_validator.get_file_category(dest_path)
-            self.logger.debug(f"Temporary file moved: {file_path} -> {dest_path} (dest category: {dest_category})")
+            self.logger.debug("Temporary file moved: %s -> %s (dest category: %s)", file_path, dest_path, dest_category)
             
             if dest_category == 'MAIN':
                 self.logger.info(f"🔄 Temporary -> Main file operation detected: {file_path} -> {dest_path}")
-                self.temp_to_main_map[file_path] = dest_path
+                self._map_temp_file(file_path, dest_path)
                 
-                if self._is_office_temp_file(file_path):
+                if _is_office_temp_file(file_path):
                     return self._handle_office_temp_to_main(file_path, dest_path)
         
         return True
 
     def _handle_office_file_creation(self, file_path: str, username: str) -> bool:
-        """Обрабатывает создание нового Office файла с поддержкой многопользовательской работы"""
+        """Планирует обработку создания Office файла после паузы, не блокируя поток watchdog"""
         self.logger.info(f"📄 Office file creation detected: {file_path}")
         
-        # Ждем немного чтобы убедиться что это не временный файл
-        time.sleep(0.5)
-        
-        if not os.path.exists(file_path):
-            self.logger.debug(f"Office creation file disappeared: {file_path}")
+        # Ждем немного чтобы убедиться что это не временный файл (в таймере, а не в потоке событий)
+        timer = threading.Timer(self.office_creation_delay, self._on_office_creation_timer, args=(file_path,))
+        timer.daemon = True
+        with self._office_creation_lock:
+            self._office_creation_timers[file_path] = (timer, username)
+        timer.start()
+        return True
+
+    def _on_office_creation_timer(self, file_path: str):
+        """Завершает создание Office файла по таймеру, если его не поглотило более раннее событие"""
+        with self._office_creation_lock:
+            pending = self._office_creation_timers.get(file_path)
+            # Таймер выполняется в собственном потоке: сверяем, что запись принадлежит именно ему
+            if pending is None or pending[0] is not threading.current_thread():
+                return
+            del self._office_creation_timers[file_path]
+            self._finalize_office_creation(file_path, pending[1])
+
+    def _flush_office_creation(self, file_path: str):
+        """Отменяет таймер и сразу завершает отложенное создание Office файла"""
+        with self._office_creation_lock:
+            pending = self._office_creation_timers.pop(file_path, None)
+            if pending is None:
+                return  # таймер уже сработал (и завершил обработку под этим же локом)
+            pending[0].cancel()
+            self._finalize_office_creation(file_path, pending[1])
+
+    def _flush_office_creations(self):
+        """Завершает все отложенные создания Office файлов (при остановке)"""
+        for file_path in tuple(self._office_creation_timers):
+            self._flush_office_creation(file_path)
+
+    def _finalize_office_creation(self, file_path: str, username: str) -> bool:
+        """Завершает обработку создания Office файла (вызывать под _office_creation_lock)"""
+        try:
+            return self._process_office_file_creation(file_path, username)
+        except Exception as e:
+            self.stats['events_failed'] += 1
+            self.logger.error(f"Error handling Office creation for {file_path}: {e}")
+            return False
+
+    def _process_office_file_creation(self, file_path: str, username: str) -> bool:
+        """Обрабатывает создание нового Office файла с поддержкой многопользовательской работы"""
+        file_stat = _try_stat(file_path)
+        if file_stat is None:
+            self.logger.debug("Office creation file disappeared: %s", file_path)
             return True
             
         # Получаем текущих редакторов
         current_editors = self._get_current_editors(file_path)
         primary_editor = self._determine_primary_editor(file_path, username, current_editors)
         
-        # Вычисляем хеш
+        # Вычисляем хеш (stat уже получен при проверке существования)
         file_hash = None
-        if self.config.get('hashing', {}).get('enabled', True):
-            file_hash = self.hash_calculator.calculate_file_hash_with_retry(file_path)
+        if self.hashing_enabled:
+            file_hash = self._cached_hash(file_path, file_stat)
         
         # Создаем сессию для нового Office файла
         session_data = self.session_manager.smart_create_session(file_path, primary_editor, file_hash)
         
         # ДОБАВЛЕНО: Добавляем информацию о со-редакторах
-        if len(current_editors) > 1:
-            session_data['co_editors'] = [editor for editor in current_editors if editor != primary_editor]
+        co_editors = [editor for editor in current_editors if editor != primary_editor]
+        is_multi_user = len(current_editors) > 1
+        if is_multi_user:
+            session_data['co_editors'] = co_editors
             session_data['is_multi_user'] = True
         
         self.stats['office_operations_handled'] += 1
         self.stats['sessions_created'] += 1
         
-        event_data = {
-            'file_path': file_path,
-            'file_name': os.path.basename(file_path),
-            'event_type': 'created',
-            'file_hash': file_hash,
-            'user_id': primary_editor,
-            'session_id': session_data['session_id'],
-            'resume_count': session_data.get('resume_count', 0),
-            'is_office_creation': True,
-            'is_multi_user': len(current_editors) > 1,
-            'co_editors': [editor for editor in current_editors if editor != primary_editor],
-            'source': 'server_agent',
-            'event_timestamp': datetime.now().isoformat()
-        }
+        event_data = self._build_event_data(file_path, 'created', session_data, primary_editor, current_editors, file_hash,
+                                            co_editors=co_editors, is_office_creation=True)
         
-        success = self.api_client.send_event(event_data)
+        success = self._send_event_ordered(event_data)
         if not success:
             self.logger.error(f"Failed to send Office created event for {file_path}")
         return success
@@ -837,149 +1243,98 @@ class EventHandler:
         
         # Вычисляем хеш если нужно
         file_hash = None
-        if (self.config.get('hashing', {}).get('enabled', True) and
-            os.path.exists(file_path)):
-            file_hash = self.hash_calculator.calculate_file_hash_with_retry(file_path)
+        if self.hashing_enabled:
+            file_hash = self._cached_hash(file_path)
         
         if event_type == 'created':
             session_data = self.session_manager.smart_create_session(file_path, primary_editor, file_hash)
             
             # ДОБАВЛЕНО: Добавляем информацию о со-редакторах
-            if len(current_editors) > 1:
-                session_data['co_editors'] = [editor for editor in current_editors if editor != primary_editor]
+            co_editors = [editor for editor in current_editors if editor != primary_editor]
+            is_multi_user = len(current_editors) > 1
+            if is_multi_user:
+                session_data['co_editors'] = co_editors
                 session_data['is_multi_user'] = True
             
             self.stats['cad_operations_handled'] += 1
             self.stats['sessions_created'] += 1
             
-            event_data = {
-                'file_path': file_path,
-                'file_name': os.path.basename(file_path),
-                'event_type': 'created',
-                'file_hash': file_hash,
-                'user_id': primary_editor,
-                'session_id': session_data['session_id'],
-                'resume_count': session_data.get('resume_count', 0),
-                'is_cad_file': True,
-                'is_multi_user': len(current_editors) > 1,
-                'co_editors': [editor for editor in current_editors if editor != primary_editor],
-                'source': 'server_agent',
-                'event_timestamp': datetime.now().isoformat()
-            }
+            event_data = self._build_event_data(file_path, 'created', session_data, primary_editor, current_editors, file_hash,
+                                                co_editors=co_editors, is_cad_file=True)
         elif event_type == 'modified':
             session_data = self.session_manager.smart_create_session(file_path, primary_editor, file_hash)
             
             # ДОБАВЛЕНО: Добавляем информацию о со-редакторах
-            if len(current_editors) > 1:
-                session_data['co_editors'] = [editor for editor in current_editors if editor != primary_editor]
+            co_editors = [editor for editor in current_editors if editor != primary_editor]
+            is_multi_user = len(current_editors) > 1
+            if is_multi_user:
+                session_data['co_editors'] = co_editors
                 session_data['is_multi_user'] = True
             
-            event_data = {
-                'file_path': file_path,
-                'file_name': os.path.basename(file_path),
-                'event_type': 'modified',
-                'file_hash': file_hash,
-                'user_id': primary_editor,
-                'session_id': session_data['session_id'],
-                'resume_count': session_data.get('resume_count', 0),
-                'is_cad_file': True,
-                'is_multi_user': len(current_editors) > 1,
-                'co_editors': [editor for editor in current_editors if editor != primary_editor],
-                'source': 'server_agent',
-                'event_timestamp': datetime.now().isoformat()
-            }
+            event_data = self._build_event_data(file_path, 'modified', session_data, primary_editor, current_editors, file_hash,
+                                                co_editors=co_editors, is_cad_file=True)
         else:
             return False
             
-        success = self.api_client.send_event(event_data)
+        success = self._send_event_ordered(event_data)
         if not success:
             self.logger.error(f"Failed to send CAD {event_type} event for {file_path}")
         return success
 
-    def _is_office_creation_operation(self, file_path: str) -> bool:
-        """Определяет является ли файл частью операции создания Office документа"""
-        filename = os.path.basename(file_path).lower()
-        
-        office_default_names = [
-            'новый документ microsoft word.docx',
-            'новый документ microsoft word.doc',
-            'новая книга microsoft excel.xlsx', 
-            'новая книга microsoft excel.xls',
-            'новая презентация microsoft powerpoint.pptx',
-            'новая презентация microsoft powerpoint.ppt',
-            'document.docx',
-            'document.doc',
-            'workbook.xlsx',
-            'workbook.xls',
-            'presentation.pptx',
-            'presentation.ppt',
-            'лист microsoft excel.xlsx',
-            'лист microsoft excel.xls',
-            'документ microsoft word.docx',
-            'документ microsoft word.doc'
-        ]
-        
-        if filename in office_default_names:
-            return True
-            
-        office_patterns = [
-            'новый ',
-            'новая ',
-            'new ',
-            'document',
-            'workbook', 
-            'presentation',
-            'лист ',
-            'документ '
-        ]
-        
-        return any(pattern in filename for pattern in office_patterns)
-
-    def _is_office_temp_file(self, file_path: str) -> bool:
-        """Определяет является ли файл временным файлом Office"""
-        filename = os.path.basename(file_path)
-        
-        office_temp_patterns = [
-            '~$', '~wr', '~wrd', '~wrl', '~rf', '.tmp'
-        ]
-        
-        name_without_ext = os.path.splitext(filename)[0]
-        if len(name_without_ext) == 4 and all(c in '0123456789ABCDEF' for c in name_without_ext.upper()):
-            return True
-            
-        if len(name_without_ext) == 8 and all(c in '0123456789ABCDEF' for c in name_without_ext.upper()):
-            return True
-        
-        return any(pattern in filename for pattern in office_temp_patterns)
-
-    def _is_cad_operation(self, file_path: str) -> bool:
-        """Определяет является ли файл частью CAD операции"""
-        file_ext = os.path.splitext(file_path)[1].lower()
-        cad_extensions = ['.dwg', '.dxf', '.dgn', '.rvt', '.rfa', '.rte', '.sat', '.ipt', '.iam', '.prt', '.asm', '.sldprt', '.sldasm', '.3dm', '.skp', '.max', '.blend']
-        return file_ext in cad_extensions
-
-    def _is_cad_temp_file(self, file_path: str) -> bool:
-        """Определяет является ли файл временным файлом CAD"""
-        filename = os.path.basename(file_path)
-        cad_temp_patterns = ['.dwl', '.dwl2', '.sv$', '.autosave', '.bak', '.lock']
-        return any(pattern in filename for pattern in cad_temp_patterns)
-
     def _track_office_temp_file(self, file_path: str):
         """Отслеживает временный файл Office для последующей обработки"""
         self.office_creation_operations[file_path] = {
-            'detected_at': datetime.now(),
+            'detected_at': time.monotonic(),
             'type': 'office_temp'
         }
 
     def _track_cad_temp_file(self, file_path: str):
         """Отслеживает временный файл CAD"""
         dir_path = os.path.dirname(file_path)
-        for file in os.listdir(dir_path):
-            if self._is_cad_operation(file):
-                main_file = os.path.join(dir_path, file)
-                self.cad_temp_files[file_path] = main_file
-                self.logger.debug(f"🔗 Linked CAD temp file {file_path} to {main_file}")
-                break
+        cad_files = self._get_cad_files_in_dir(dir_path)
+        if not cad_files:
+            return
+        
+        main_file = os.path.join(dir_path, next(iter(cad_files)))
+        if not os.path.exists(main_file):
+            # Кэш устарел (например, каталог изменен без событий по файлам) - пересканируем
+            cad_files = self._get_cad_files_in_dir(dir_path, rescan=True)
+            if not cad_files:
+                return
+            main_file = os.path.join(dir_path, next(iter(cad_files)))
+        
+        self.cad_temp_files[file_path] = main_file
+        self.logger.debug("🔗 Linked CAD temp file %s to %s", file_path, main_file)
+
+    def _get_cad_files_in_dir(self, dir_path: str, rescan: bool = False) -> set:
+        """Возвращает имена CAD файлов каталога (из кэша или одним os.scandir)"""
+        cad_files = self._cad_files_by_dir.get(dir_path)
+        if cad_files is not None and not rescan:
+            return cad_files
+        
+        cad_files = set()
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if os.path.splitext(entry.name)[1].lower() in _CAD_EXTENSIONS:
+                    cad_files.add(entry.name)
+        self._cad_files_by_dir[dir_path] = cad_files
+        return cad_files
+
+    def _update_cad_files_index(self, event_type: str, file_path: str, dest_path: str = None):
+        """Обновляет кэш CAD файлов по событию (только для уже просканированных каталогов)"""
+        if not self._cad_files_by_dir:
+            return
+        if event_type in ('deleted', 'moved'):
+            dir_path, name = os.path.split(file_path)
+            cad_files = self._cad_files_by_dir.get(dir_path)
+            if cad_files is not None:
+                cad_files.discard(name)
+        added_path = dest_path if event_type == 'moved' else file_path if event_type == 'created' else None
+        if added_path and os.path.splitext(added_path)[1].lower() in _CAD_EXTENSIONS:
+            dir_path, name = os.path.split(added_path)
+            cad_files = self._cad_files_by_dir.get(dir_path)
+            if cad_files is not None:
+                cad_files.add(name)
 
     def _handle_office_temp_to_main(self, temp_path: str, main_path: str) -> bool:
         """Обрабатывает перемещение временного Office файла в основной"""
@@ -993,8 +1348,8 @@ class EventHandler:
         primary_editor = self._determine_primary_editor(main_path, normalized_username, current_editors)
         
         file_hash = None
-        if self.config.get('hashing', {}).get('enabled', True):
-            file_hash = self.hash_calculator.calculate_file_hash_with_retry(main_path)
+        if self.hashing_enabled:
+            file_hash = self._cached_hash(main_path)
         
         # Переносим сессию с временного файла на основной
         old_session = self.session_manager.get_active_session(temp_path, primary_editor)
@@ -1008,8 +1363,7 @@ class EventHandler:
         # Очищаем отслеживание
         if temp_path in self.office_creation_operations:
             del self.office_creation_operations[temp_path]
-        if temp_path in self.temp_to_main_map:
-            del self.temp_to_main_map[temp_path]
+        self._unmap_temp_file(temp_path)
             
         return self._send_moved_event(temp_path, main_path, primary_editor, file_hash, current_editors)
 
@@ -1044,8 +1398,8 @@ class EventHandler:
         primary_editor = self._determine_primary_editor(dest_path, normalized_username, current_editors)
         
         file_hash = None
-        if self.config.get('hashing', {}).get('enabled', True):
-            file_hash = self.hash_calculator.calculate_file_hash_with_retry(dest_path)
+        if self.hashing_enabled:
+            file_hash = self._cached_hash(dest_path)
         
         if main_file:
             old_session = self.session_manager.get_active_session(main_file, primary_editor)
@@ -1055,8 +1409,7 @@ class EventHandler:
                 )
                 if transferred_session:
                     self.logger.info(f"🔄 Transferred session from main file {main_file} to {dest_path}")
-                    if src_path in self.temp_to_main_map:
-                        del self.temp_to_main_map[src_path]
+                    self._unmap_temp_file(src_path)
                     if main_file in self.main_file_tracking:
                         del self.main_file_tracking[main_file]
                     
@@ -1065,8 +1418,7 @@ class EventHandler:
         self.session_manager.smart_create_session(dest_path, primary_editor, file_hash)
         self.logger.info(f"✅ Created new session for moved file {dest_path}")
         
-        if src_path in self.temp_to_main_map:
-            del self.temp_to_main_map[src_path]
+        self._unmap_temp_file(src_path)
             
         return self._send_moved_event(src_path, dest_path, primary_editor, file_hash, current_editors)
 
@@ -1080,8 +1432,8 @@ class EventHandler:
         primary_editor = self._determine_primary_editor(dest_path, normalized_username, current_editors)
         
         file_hash = None
-        if self.config.get('hashing', {}).get('enabled', True):
-            file_hash = self.hash_calculator.calculate_file_hash_with_retry(dest_path)
+        if self.hashing_enabled:
+            file_hash = self._cached_hash(dest_path)
         
         session_transferred = False
         old_session = self.session_manager.get_active_session(src_path, primary_editor)
@@ -1098,8 +1450,8 @@ class EventHandler:
             self.session_manager.smart_create_session(dest_path, primary_editor, file_hash)
             self.logger.info(f"✅ Created new session for moved file {dest_path}")
         
-        self.file_renames[src_path] = dest_path
-        self.file_move_chains[src_path] = dest_path
+        self._record_move(self.file_renames, src_path, dest_path)
+        self._record_move(self.file_move_chains, src_path, dest_path)
         
         return self._send_moved_event(src_path, dest_path, primary_editor, file_hash, current_editors)
 
@@ -1113,8 +1465,8 @@ class EventHandler:
         primary_editor = self._determine_primary_editor(dest_path, normalized_username, current_editors)
         
         file_hash = None
-        if self.config.get('hashing', {}).get('enabled', True):
-            file_hash = self.hash_calculator.calculate_file_hash_with_retry(dest_path)
+        if self.hashing_enabled:
+            file_hash = self._cached_hash(dest_path)
         
         main_file = self._find_related_main_file(src_path, dest_path)
         
@@ -1143,8 +1495,8 @@ class EventHandler:
         primary_editor = self._determine_primary_editor(dest_path, normalized_username, current_editors)
         
         file_hash = None
-        if self.config.get('hashing', {}).get('enabled', True):
-            file_hash = self.hash_calculator.calculate_file_hash_with_retry(dest_path)
+        if self.hashing_enabled:
+            file_hash = self._cached_hash(dest_path)
         
         if dest_category == 'MAIN':
             related_file = self._find_related_main_file(src_path, dest_path)
@@ -1164,18 +1516,20 @@ class EventHandler:
 
     def _find_related_main_file(self, src_path: str, dest_path: str) -> Optional[str]:
         """Находит связанный основной файл по имени или пути"""
-        src_name = os.path.basename(src_path)
-        dest_name = os.path.basename(dest_path)
+        src_name = _file_name(src_path)
+        dest_name = _file_name(dest_path)
         
-        for chain_src, chain_dest in self.file_move_chains.items():
-            if chain_dest == src_path:
-                chain_category = self.file_validator.get_file_category(chain_src)
-                if chain_category == 'MAIN':
-                    return chain_src
+        # Обход цепочек только если src_path действительно является чьим-то назначением
+        if src_path in self._move_targets:
+            for chain_src, chain_dest in self.file_move_chains.items():
+                if chain_dest == src_path:
+                    chain_category = self.file_validator.get_file_category(chain_src)
+                    if chain_category == 'MAIN':
+                        return chain_src
         
-        for temp_file, main_file in self.temp_to_main_map.items():
-            if temp_file == src_path:
-                return main_file
+        main_file = self.temp_to_main_map.get(src_path)
+        if main_file is not None:
+            return main_file
         
         if src_name.isalnum() and len(src_name) == 8:
             dir_path = os.path.dirname(dest_path)
@@ -1188,7 +1542,7 @@ class EventHandler:
     # def _normalize_username(self, username: str) -> str:
     #     """Нормализует имя пользователя к единому формату"""
     #     if not username:
-    #         return getpass.getuser()
+    #         return _CURRENT_USER
         
     #     if '\\' in username:
     #         parts = username.split('\\')
@@ -1202,36 +1556,31 @@ class EventHandler:
     def _normalize_username(self, username: str) -> str:
         """Нормализует имя пользователя к единому формату - УЛУЧШЕННАЯ ВЕРСИЯ"""
         if not username or username == 'unknown':
-            return getpass.getuser()
-    
-        if '\\' in username:
-            parts = username.split('\\')
-            return parts[-1]
-        return username
+            return _CURRENT_USER
+        return _normalize_username_impl(username)
 
     def _should_process_event(self, file_path: str, event_type: str) -> bool:
         """Определяет нужно ли обрабатывать событие (фильтр частых событий)"""
-        current_time = datetime.now()
-        event_key = f"{file_path}:{event_type}"
-        
         if event_type in ('deleted', 'moved'):
             return True
-            
-        if event_key in self.recent_events:
-            time_since_last = (current_time - self.recent_events[event_key]).total_seconds()
-            if time_since_last < self.event_cooldown:
-                return False
         
-        self.recent_events[event_key] = current_time
+        current_time = time.monotonic()
+        event_key = (file_path, event_type)
+        recent_events = self.recent_events
         
-        old_entries = []
-        for key, event_time in self.recent_events.items():
-            if (current_time - event_time).total_seconds() > 10:
-                old_entries.append(key)
+        last_time = recent_events.get(event_key)
+        if last_time is not None and current_time - last_time < self.event_cooldown:
+            return False
+        
+        # Записи упорядочены по времени: свежая уходит в конец, устаревшие снимаются с начала
+        recent_events[event_key] = current_time
+        recent_events.move_to_end(event_key)
+        while recent_events:
+            oldest_key, oldest_time = next(iter(recent_events.items()))
+            if current_time - oldest_time <= 10 and len(recent_events) <= self.recent_events_max:
+                break
+            del recent_events[oldest_key]
         
-        for key in old_entries:
-            del self.recent_events[key]
-            
         return True
 
     def _is_file_really_opened(self, file_path: str) -> bool:
@@ -1246,16 +1595,16 @@ class EventHandler:
             
             if is_opened:
                 self.verified_open_files.add(file_path)
-                self.logger.debug(f"✅ File is really opened: {file_path} by {len(processes)} processes")
+                self.logger.debug("✅ File is really opened: %s by %s processes", file_path, len(processes))
             else:
                 if file_path in self.verified_open_files:
                     self.verified_open_files.remove(file_path)
-                    self.logger.debug(f"📁 File no longer opened: {file_path}")
+                    self.logger.debug("📁 File no longer opened: %s", file_path)
             
             return is_opened
             
         except Exception as e:
-            self.logger.debug(f"Error checking if file is opened: {e}")
+            self.logger.debug("Error checking if file is opened: %s", e)
             return True
 
     # def _get_processes_using_file(self, file_path: str) -> list:
@@ -1361,51 +1710,160 @@ class EventHandler:
         
     #     return processes
 
-    def _get_processes_using_file(self, file_path: str) -> list:
-        """Возвращает список процессов, использующих файл - ОПТИМИЗИРОВАННАЯ ВЕРСИЯ"""
+    def _build_open_files_index(self) -> Dict[str, list]:
+        """Строит индекс нормализованный путь -> процессы за один проход по процессам"""
+        if _HAS_PROC_FS:
+            return self._build_open_files_index_proc()
+        
+        index = {}
+        seen = set()
+        # Собственные дескрипторы агента (хеширование в пуле) не делают его "редактором" файла
+        own_pid = os.getpid()
+        # open_files - самый дорогой атрибут; запрашивается только для процессов, прошедших фильтры
+        for proc in psutil.process_iter(['pid', 'name', 'username']):
+            try:
+                if proc.pid == own_pid:
+                    continue
+                proc_name = proc.info['name']
+                
+                # Быстрая проверка системных процессов
+                if not proc_name or proc_name.lower() in _SYSTEM_PROCESS_NAMES:
+                    continue
+                
+                process_username = self._normalize_username(proc.info.get('username') or 'unknown')
+                
+                # Фильтр системных пользователей
+                if not process_username or process_username.lower() in _SYSTEM_USER_NAMES:
+                    continue
+                
+                open_files = proc.open_files()
+                if not open_files:
+                    continue
+                
+                process_info = {
+                    'pid': proc.pid,
+                    'name': proc_name,
+                    'username': process_username
+                }
+                for file in open_files:
+                    open_file_path = _normalize_path(file.path)
+                    # Один процесс учитывается для пути только один раз
+                    if (proc.pid, open_file_path) in seen:
+                        continue
+                    seen.add((proc.pid, open_file_path))
+                    index.setdefault(open_file_path, []).append(process_info)
+                    
+            except (psutil.NoSuchProcess, psutil.AccessDenied, FileNotFoundError):
+                continue
+        
+        return index
+    
+    def _build_open_files_index_proc(self) -> Dict[str, list]:
+        """Строит индекс открытых файлов по /proc: только readlink дескрипторов, без psutil.open_files()"""
+        index = {}
+        watch_roots = self._watch_roots
+        watch_root_prefixes = self._watch_root_prefixes
+        own_pid = str(os.getpid())
+        
+        for entry in os.scandir('/proc'):
+            if not entry.name.isdigit() or entry.name == own_pid:
+                continue
+            fd_dir = f"/proc/{entry.name}/fd"
+            try:
+                fds = os.listdir(fd_dir)
+            except OSError:
+                continue  # процесс завершился или нет доступа
+            
+            paths = set()
+            for fd in fds:
+                try:
+                    target = os.readlink(f"{fd_dir}/{fd}")
+                except OSError:
+                    continue
+                # socket:[...], pipe:[...], anon_inode:... - не файлы
+                if not target.startswith('/'):
+                    continue
+                open_file_path = _normalize_path(target)
+                if watch_roots and not (open_file_path.startswith(watch_root_prefixes)
+                                        or open_file_path in watch_roots):
+                    continue
+                paths.add(open_file_path)
+            
+            if not paths:
+                continue
+            
+            process_info = self._read_proc_process_info(int(entry.name))
+            if process_info is None:
+                continue
+            for open_file_path in paths:
+                index.setdefault(open_file_path, []).append(process_info)
+        
+        return index
+    
+    def _read_proc_process_info(self, pid: int) -> Optional[dict]:
+        """Читает имя и владельца процесса из /proc (None для системных процессов)"""
+        try:
+            with open(f"/proc/{pid}/comm") as f:
+                proc_name = f.read().strip()
+            uid = os.stat(f"/proc/{pid}").st_uid
+        except OSError:
+            return None
+        
+        if not proc_name or proc_name.lower() in _SYSTEM_PROCESS_NAMES:
+            return None
+        
+        process_username = self._normalize_username(_uid_to_username(uid))
+        if not process_username or process_username.lower() in _SYSTEM_USER_NAMES:
+            return None
+        
+        return {
+            'pid': pid,
+            'name': proc_name,
+            'username': process_username
+        }
+    
+    def _get_open_files_index(self, max_age: float = None) -> Dict[str, list]:
+        """Возвращает индекс открытых файлов, пересобирая его, если он старше max_age секунд"""
+        if max_age is None:
+            max_age = self.open_files_index_ttl
+        now = time.monotonic()
+        with self._open_files_index_lock:
+            if self._open_files_index is None or now - self._open_files_index_ts >= max_age:
+                self._open_files_index = self._build_open_files_index()
+                self._open_files_index_ts = time.monotonic()
+            return self._open_files_index
+    
+    def _open_files_refresh_loop(self):
+        """Периодически пересобирает индекс открытых файлов вне потока обработки событий"""
+        while not self._open_files_refresh_stop.wait(self.open_files_refresh_interval):
+            # Без отслеживаемых файлов полный обход процессов не нужен
+            if not self.open_files:
+                continue
+            try:
+                index = self._build_open_files_index()
+            except Exception as e:
+                self.logger.error(f"❌ Error refreshing open files index: {e}")
+                continue
+            # Индекс собирается без блокировки; читатели получают готовый словарь
+            with self._open_files_index_lock:
+                self._open_files_index = index
+                self._open_files_index_ts = time.monotonic()
+    
+    def _get_processes_using_file(self, file_path: str, index: Dict[str, list] = None) -> list:
+        """Возвращает список процессов, использующих файл (по индексу открытых файлов)"""
         if not psutil:
             return []
 
         processes = []
         try:
-            normalized_path = os.path.normpath(file_path).lower()
+            if index is None:
+                index = self._get_open_files_index()
+            processes = list(index.get(_open_file_key(file_path), ()))
         
-            # УПРОЩЕННОЕ ЛОГИРОВАНИЕ - только при нахождении процессов
-            for proc in psutil.process_iter(['pid', 'name', 'username', 'open_files']):
-                try:
-                    proc_name = proc.info['name']
-                
-                    # Быстрая проверка системных процессов
-                    if proc_name.lower() in ['system', 'svchost.exe', 'explorer.exe']:
-                        continue
-                    
-                    open_files = proc.info.get('open_files')
-                    if open_files is None:
-                        continue
-                
-                    for file in open_files:
-                        open_file_path = os.path.normpath(file.path).lower()
-                        if open_file_path == normalized_path:
-                            process_username = self._normalize_username(proc.info.get('username', 'unknown'))
-                        
-                            # Фильтр системных пользователей
-                            if not process_username or process_username.lower() in ['system', 'network service']:
-                                continue
-                            
-                            processes.append({
-                                'pid': proc.pid,
-                                'name': proc_name,
-                                'username': process_username
-                            })
-                            break
-                        
-                except (psutil.NoSuchProcess, psutil.AccessDenied, FileNotFoundError):
-                    continue
-        
-            # ЛОГИРОВАТЬ ТОЛЬКО ПРИ НАЛИЧИИ ПРОЦЕССОВ ИЛИ ОШИБКАХ
-            if processes:
+            # ЛОГИРОВАТЬ ТОЛЬКО ПРИ НАЛИЧИИ ПРОЦЕССОВ ИЛИ ОШИБКАХ (список имен строим только для DEBUG)
+            if processes and self.logger.isEnabledFor(logging.DEBUG):
                 usernames = [p['username'] for p in processes]
-                self.logger.debug(f"🔍 Found {len(processes)} processes for {os.path.basename(file_path)}: {usernames}")
+                self.logger.debug("🔍 Found %s processes for %s: %s", len(processes), _file_name(file_path), usernames)
             
         except Exception as e:
             self.logger.error(f"❌ Error getting processes for {file_path}: {e}")
@@ -1419,38 +1877,176 @@ class EventHandler:
             
         try:
             current_processes = self._get_processes_using_file(file_path)
-            current_time = datetime.now()
+            current_time = time.monotonic()
             
             if current_processes:
-                self.open_files[file_path] = {
-                    'username': username,
-                    'processes': current_processes,
-                    'last_activity': current_time,
-                    'last_checked': current_time,
-                    'event_type': event_type
-                }
-                self.logger.debug(f"File {file_path} is open in {len(current_processes)} processes")
+                with self._open_files_lock:
+                    self.open_files[file_path] = _OpenFileRecord(
+                        username, current_processes, current_time, current_time, event_type
+                    )
+                self.logger.debug("File %s is open in %s processes", file_path, len(current_processes))
             else:
                 if file_path in self.open_files:
                     file_info = self.open_files[file_path]
-                    time_since_last_activity = current_time - file_info['last_activity']
                     
-                    if time_since_last_activity > timedelta(seconds=5):
+                    if current_time - file_info.last_activity > self.open_file_close_delay:
                         self.logger.info(f"File {file_path} is no longer open, closing session")
                         
                         file_hash = None
-                        if os.path.exists(file_path) and self.config.get('hashing', {}).get('enabled', True):
-                            file_hash = self.hash_calculator.calculate_file_hash_with_retry(file_path)
+                        if self.hashing_enabled:
+                            file_hash = self._cached_hash(file_path)
                         
-                        self._handle_file_closed(file_path, file_info['username'], file_hash)
-                        del self.open_files[file_path]
+                        self._handle_file_closed(file_path, file_info.username, file_hash)
+                        with self._open_files_lock:
+                            self.open_files.pop(file_path, None)
                         self.stats['files_closed'] += 1
                     else:
-                        self.open_files[file_path]['last_checked'] = current_time
+                        self.open_files[file_path].last_checked = current_time
                         
         except Exception as e:
             self.logger.error(f"Error updating open file tracking for {file_path}: {e}")
 
+    def _cached_hash(self, file_path: str, stat: os.stat_result = None) -> Optional[str]:
+        """Возвращает хеш файла, пересчитывая его только при изменении mtime/размера"""
+        if stat is None:
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                self._invalidate_hash(file_path)
+                return None
+            except OSError:
+                return self.hash_calculator.calculate_file_hash_with_retry(file_path)
+        
+        # Инод учитывается: замена файла через rename (сохранение Office) может сохранить mtime и размер
+        key = (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self._hash_cache_lock:
+            cached = self._hash_cache.get(file_path)
+            if cached is not None and cached[0] == key:
+                self._hash_cache.move_to_end(file_path)
+                return cached[1]
+        
+        file_hash = self.hash_calculator.calculate_file_hash_with_retry(file_path)
+        if file_hash is not None:
+            with self._hash_cache_lock:
+                self._hash_cache[file_path] = (key, file_hash)
+                self._hash_cache.move_to_end(file_path)
+                if len(self._hash_cache) > self._hash_cache_size:
+                    self._hash_cache.popitem(last=False)
+        return file_hash
+
+    def _invalidate_hash(self, file_path: str):
+        """Удаляет хеш файла из кэша"""
+        with self._hash_cache_lock:
+            self._hash_cache.pop(file_path, None)
+
+    def _hash_files_parallel(self, file_paths) -> Dict[str, Optional[str]]:
+        """Хеширует существующие файлы параллельно в пуле потоков"""
+        if not self.hashing_enabled:
+            return {}
+        
+        futures = {}
+        for file_path in file_paths:
+            if file_path not in futures:
+                futures[file_path] = self._hash_pool.submit(
+                    self._cached_hash, file_path
+                )
+        
+        file_hashes = {}
+        for file_path, future in futures.items():
+            try:
+                file_hashes[file_path] = future.result()
+            except Exception as e:
+                self.logger.error(f"❌ Error hashing {file_path}: {e}")
+        return file_hashes
+
+    def _send_event_hashed(self, event_data: Dict[str, Any], session_data: Dict, error_message: str) -> bool:
+        """Ставит хеширование в пул и отправляет событие после него, не блокируя поток watchdog"""
+        if not self.hashing_enabled:
+            success = self.api_client.send_event(event_data)
+            if not success:
+                self.logger.error(error_message)
+            return success
+        
+        file_path = event_data['file_path']
+        with self._pending_hashes_lock:
+            previous = self._pending_hashes.get(file_path)
+            future = self._hash_pool.submit(self._hash_and_send, event_data, session_data, error_message, previous)
+            self._pending_hashes[file_path] = future
+        future.add_done_callback(lambda f: self._release_pending_hash(file_path, f))
+        return True
+
+    def _hash_and_send(self, event_data: Dict[str, Any], session_data: Dict, error_message: str, previous=None):
+        """Вычисляет хеш файла, дополняет событие и сессию и отправляет событие"""
+        # Предыдущая задача того же файла взята из очереди раньше, поэтому ожидание не блокирует пул
+        if previous is not None:
+            wait([previous])
+        
+        file_path = event_data['file_path']
+        file_hash = None
+        try:
+            file_hash = self._cached_hash(file_path)
+        except Exception as e:
+            self.logger.error(f"❌ Error hashing {file_path}: {e}")
+        
+        event_data['file_hash'] = file_hash
+        if session_data.get('hash_before') is None:
+            session_data['hash_before'] = file_hash
+        
+        if not self.api_client.send_event(event_data):
+            self.logger.error(error_message)
+
+    def _send_event_ordered(self, event_data: Dict[str, Any], paths=None) -> bool:
+        """Отправляет событие после незавершенных задач хеширования/отправки тех же файлов"""
+        if paths is None:
+            paths = (event_data['file_path'],)
+        
+        future = None
+        with self._pending_hashes_lock:
+            previous = [self._pending_hashes[path] for path in paths if path in self._pending_hashes]
+            if previous:
+                try:
+                    future = self._hash_pool.submit(self._send_after, event_data, previous)
+                except RuntimeError:
+                    # Пул уже остановлен (завершение работы) - предыдущие задачи выполнены
+                    future = None
+                else:
+                    for path in paths:
+                        self._pending_hashes[path] = future
+        
+        if future is None:
+            return self.api_client.send_event(event_data)
+        
+        for path in paths:
+            future.add_done_callback(lambda f, path=path: self._release_pending_hash(path, f))
+        return True
+
+    def _send_events_batch_ordered(self, events: list) -> bool:
+        """Отправляет пакет событий; события файлов с незавершенными задачами встают за ними в очередь"""
+        with self._pending_hashes_lock:
+            chained = [event_data for event_data in events if event_data['file_path'] in self._pending_hashes]
+        if not chained:
+            return self.api_client.send_events_batch(events)
+        
+        chained_ids = set(map(id, chained))
+        direct = [event_data for event_data in events if id(event_data) not in chained_ids]
+        success = self.api_client.send_events_batch(direct) if direct else True
+        for event_data in chained:
+            success = self._send_event_ordered(event_data) and success
+        return success
+
+    def _send_after(self, event_data: Dict[str, Any], previous: list):
+        """Отправляет событие после завершения предыдущих задач тех же файлов"""
+        # Предыдущие задачи взяты из очереди пула раньше, поэтому ожидание не блокирует пул
+        wait(previous)
+        if not self.api_client.send_event(event_data):
+            self.logger.error(f"❌ Failed to send {event_data['event_type']} event for: {event_data['file_path']}")
+
+    def _release_pending_hash(self, file_path: str, future):
+        """Убирает завершенную задачу хеширования из индекса, если она последняя для файла"""
+        with self._pending_hashes_lock:
+            if self._pending_hashes.get(file_path) is future:
+                del self._pending_hashes[file_path]
+
     def _handle_file_closed(self, file_path: str, username: str, file_hash: str) -> bool:
         """Обрабатывает закрытие файла"""
         self.logger.info(f"File closed: {file_path} by {username}")
@@ -1469,22 +2065,11 @@ class EventHandler:
             
             session_duration = (session_data['ended_at'] - session_data['started_at']).total_seconds()
             
-            event_data = {
-                'file_path': file_path,
-                'file_name': os.path.basename(file_path),
-                'event_type': 'closed',
-                'file_hash': file_hash,
-                'user_id': primary_editor,
-                'session_id': session_data['session_id'],
-                'resume_count': session_data.get('resume_count', 0),
-                'session_duration': session_duration,
-                'is_multi_user': len(current_editors) > 1,
-                'co_editors': [editor for editor in current_editors if editor != primary_editor],
-                'source': 'server_agent',
-                'event_timestamp': session_data['ended_at'].isoformat()
-            }
+            event_data = self._build_event_data(file_path, 'closed', session_data, primary_editor, current_editors, file_hash,
+                                                event_timestamp=session_data['ended_at'].isoformat(),
+                                                session_duration=session_duration)
             
-            success = self.api_client.send_event(event_data)
+            success = self._send_event_ordered(event_data)
             if success:
                 self.logger.info(f"✅ Successfully closed session for {file_path} (duration: {session_duration:.1f}s, ended_at: {session_data['ended_at']})")
             else:
@@ -1500,41 +2085,45 @@ class EventHandler:
             return
             
         try:
-            current_time = datetime.now()
-            check_interval = timedelta(seconds=30)
+            current_time = time.monotonic()
             
-            if current_time - self.last_open_files_check < check_interval:
+            if current_time - self.last_open_files_check < self.open_files_check_interval:
                 return
                 
             self.last_open_files_check = current_time
             
             files_to_close = []
+            close_delay = self.open_file_close_delay
             
-            for file_path, file_info in list(self.open_files.items()):
-                current_processes = self._get_processes_using_file(file_path)
-                
-                if not current_processes:
-                    file_info = self.open_files[file_path]
-                    time_since_last_activity = current_time - file_info['last_activity']
+            # Один свежий снимок процессов на весь проход
+            open_files_index = self._get_open_files_index(max_age=0)
+            
+            # Итерируем словарь напрямую, без копии: под блокировкой его не изменяют
+            # другие потоки, а удаление закрытых файлов выполняется после цикла
+            with self._open_files_lock:
+                for file_path, file_info in self.open_files.items():
+                    current_processes = self._get_processes_using_file(file_path, open_files_index)
                     
-                    if time_since_last_activity > timedelta(seconds=5):
-                        files_to_close.append((file_path, file_info))
+                    if not current_processes:
+                        if current_time - file_info.last_activity > close_delay:
+                            files_to_close.append((file_path, file_info))
+                        else:
+                            file_info.last_checked = current_time
                     else:
-                        file_info['last_checked'] = current_time
-                else:
-                    file_info['processes'] = current_processes
-                    file_info['last_checked'] = current_time
+                        file_info.processes = current_processes
+                        file_info.last_checked = current_time
             
+            file_hashes = self._hash_files_parallel(file_path for file_path, _ in files_to_close)
             for file_path, file_info in files_to_close:
                 self.logger.info(f"Detected file closure: {file_path}")
                 
-                file_hash = None
-                if os.path.exists(file_path) and self.config.get('hashing', {}).get('enabled', True):
-                    file_hash = self.hash_calculator.calculate_file_hash_with_retry(file_path)
-                
-                self._handle_file_closed(file_path, file_info['username'], file_hash)
-                del self.open_files[file_path]
+                file_hash = file_hashes.get(file_path)
+                self._handle_file_closed(file_path, file_info.username, file_hash)
                 self.stats['files_closed'] += 1
+            
+            with self._open_files_lock:
+                for file_path, _ in files_to_close:
+                    self.open_files.pop(file_path, None)
                 
         except Exception as e:
             self.logger.error(f"Error checking open files: {e}")
@@ -1546,6 +2135,11 @@ class EventHandler:
             expired_sessions = self.session_manager.check_and_close_expired_sessions()
             closed_count = 0
             
+            file_hashes = self._hash_files_parallel(
+                session_data['file_path'] for session_data in expired_sessions
+                if session_data.get('ended_at') is not None
+            )
+            events = []
             for session_data in expired_sessions:
                 file_path = session_data['file_path']
                 username = session_data['username']
@@ -1556,34 +2150,27 @@ class EventHandler:
                     self.logger.error(f"❌ Session closed but ended_at is None for: {file_path}")
                     continue
                 
-                file_hash = None
-                if os.path.exists(file_path) and self.config.get('hashing', {}).get('enabled', True):
-                    file_hash = self.hash_calculator.calculate_file_hash_with_retry(file_path)
+                file_hash = file_hashes.get(file_path)
                 
                 # Получаем текущих редакторов для события closed
                 current_editors = self._get_current_editors(file_path)
                 primary_editor = self._determine_primary_editor(file_path, username, current_editors)
                 
-                event_data = {
-                    'file_path': file_path,
-                    'file_name': session_data.get('file_name', os.path.basename(file_path)),
-                    'event_type': 'closed',
-                    'file_hash': file_hash,
-                    'user_id': primary_editor,
-                    'session_id': session_data['session_id'],
-                    'resume_count': session_data.get('resume_count', 0),
-                    'session_duration': (session_data['ended_at'] - session_data['started_at']).total_seconds(),
-                    'is_multi_user': len(current_editors) > 1,
-                    'co_editors': [editor for editor in current_editors if editor != primary_editor],
-                    'source': 'server_agent',
-                    'event_timestamp': session_data['ended_at'].isoformat()
-                }
-                
-                success = self.api_client.send_event(event_data)
-                if success:
-                    self.logger.info(f"✅ Closed expired session: {file_path} (ended_at: {session_data['ended_at']})")
+                event_data = self._build_event_data(
+                    file_path, 'closed', session_data, primary_editor, current_editors, file_hash,
+                    event_timestamp=session_data['ended_at'].isoformat(),
+                    file_name=session_data.get('file_name', _file_name(file_path)),
+                    session_duration=(session_data['ended_at'] - session_data['started_at']).total_seconds()
+                )
+                events.append(event_data)
+            
+            # События закрытия ставятся в очередь одним пакетом
+            if events:
+                if self._send_events_batch_ordered(events):
+                    for event_data in events:
+                        self.logger.info(f"✅ Closed expired session: {event_data['file_path']} (ended_at: {event_data['event_timestamp']})")
                 else:
-                    self.logger.error(f"❌ Failed to send closed event for: {file_path}")
+                    self.logger.error(f"❌ Failed to enqueue {len(events)} closed events (cached for retry)")
             
             return closed_count
             
@@ -1595,36 +2182,53 @@ class EventHandler:
         """Очищает сессии для файлов, которые больше не существуют"""
         expired_sessions = []
         
-        for session_key, session_data in list(self.session_manager.active_sessions.items()):
+        # Один проход по снимку сессий; существование проверяем один раз на файл,
+        # даже если с ним работают несколько пользователей
+        file_exists = {}
+        orphaned = []
+        for session_data in tuple(self.session_manager.active_sessions.values()):
+            file_path = session_data['file_path']
+            if file_path not in file_exists:
+                file_exists[file_path] = os.path.exists(file_path)
+            if not file_exists[file_path]:
+                orphaned.append(session_data)
+        
+        # Одна метка времени на весь пакет событий
+        now_iso = _now_iso()
+        events = []
+        for session_data in orphaned:
             file_path = session_data['file_path']
             username = session_data['username']
             
-            if not os.path.exists(file_path):
-                self.logger.info(f"Closing orphaned session for deleted file: {file_path}")
-                closed_session = self.session_manager.close_session(file_path, username)
-                if closed_session:
-                    expired_sessions.append(closed_session)
-                    
-                    # Получаем текущих редакторов для события deleted
-                    current_editors = self._get_current_editors(file_path)
-                    primary_editor = self._determine_primary_editor(file_path, username, current_editors)
-                    
-                    event_data = {
-                        'file_path': file_path,
-                        'file_name': os.path.basename(file_path),
-                        'event_type': 'deleted',
-                        'user_id': primary_editor,
-                        'session_id': closed_session['session_id'],
-                        'resume_count': closed_session.get('resume_count', 0),
-                        'is_multi_user': len(current_editors) > 1,
-                        'co_editors': [editor for editor in current_editors if editor != primary_editor],
-                        'source': 'server_agent',
-                        'event_timestamp': datetime.now().isoformat()
-                    }
-                    self.api_client.send_event(event_data)
+            self.logger.info(f"Closing orphaned session for deleted file: {file_path}")
+            closed_session = self.session_manager.close_session(file_path, username)
+            if closed_session:
+                expired_sessions.append(closed_session)
+                
+                # Получаем текущих редакторов для события deleted
+                current_editors = self._get_current_editors(file_path)
+                primary_editor = self._determine_primary_editor(file_path, username, current_editors)
+                
+                events.append(self._build_event_data(file_path, 'deleted', closed_session, primary_editor, current_editors,
+                                                     event_timestamp=now_iso))
+        
+        if events:
+            self._send_events_batch_ordered(events)
         
         return expired_sessions
 
+    def reload_config(self, monitoring_config=None):
+        """Перечитывает конфигурацию и обновляет закэшированные из нее настройки"""
+        self.config = get_monitoring_config() if monitoring_config is None else monitoring_config
+        
+        hashing_config = self.config.get('hashing', {})
+        self.hash_calculator = HashCalculator(hashing_config)
+        self.hashing_enabled = bool(hashing_config.get('enabled', True))
+        self.session_manager.set_config(self.config.get('sessions', {}))
+        self.office_creation_delay = self.config.get('office_creation_delay', 0.5)
+        
+        self.logger.info(f"⚙️ Configuration reloaded: hashing={self.hashing_enabled}")
+
     def get_stats(self) -> Dict[str, Any]:
         """Возвращает статистику обработки"""
         session_stats = self.session_manager.get_session_stats()
@@ -1638,39 +2242,52 @@ class EventHandler:
             'main_files_tracked': len(self.main_file_tracking),
             'office_operations': len(self.office_creation_operations),
             'cad_temp_files': len(self.cad_temp_files),
-            'multi_user_files': len([f for f, editors in self.file_editors.items() if len(editors.get('co_editors', set())) > 0])
+            'multi_user_files': sum(1 for editors in self.file_editors.values() if editors.co_editors),
+            'path_classification_cache_hits': sum(predicate.cache_info().hits for predicate in _PATH_PREDICATES)
         }
 
     def cleanup(self):
         """Очищает ресурсы"""
+        # Отложенные создания Office файлов отправляются до остановки пула и API клиента
+        self._flush_office_creations()
+        
         expired_sessions = self.session_manager.cleanup_expired_sessions(self)
+        file_hashes = self._hash_files_parallel(session_data['file_path'] for session_data in expired_sessions)
         for session_data in expired_sessions:
             file_path = session_data['file_path']
             username = session_data['username']
-            file_hash = None
-            if os.path.exists(file_path) and self.config.get('hashing', {}).get('enabled', True):
-                file_hash = self.hash_calculator.calculate_file_hash_with_retry(file_path)
-            self._handle_file_closed(file_path, username, file_hash)
+            self._handle_file_closed(file_path, username, file_hashes.get(file_path))
         
+        self._open_files_refresh_stop.set()
         self.check_open_files()
         self.cleanup_orphaned_sessions()
+        # Дожидаемся отложенных событий created/modified до сброса очереди API
+        self._hash_pool.shutdown(wait=True)
+        
+        self._save_audit_bookmark()
+        
+        # Дожидаемся отправки оставшихся событий из очереди
+        if not self.api_client.flush():
+            self.logger.warning("⚠️ Event queue was not fully flushed before shutdown")
+        self.api_client.close()
 
     def notify_other_agents(self, endpoint: str, data: dict):
         """Уведомляет другие агенты о событиях"""
         for agent_url in self.other_agents:
             try:
                 full_url = f"{agent_url}/api/agent/{endpoint}"
-                response = requests.post(
+                # Пул keep-alive соединений API-клиента вместо нового TCP-соединения на каждый вызов
+                response = self.api_client.session.post(
                     full_url,
                     json=data,
                     timeout=5
                 )
                 if response.status_code == 200:
-                    self.logger.debug(f"✅ Notified agent {agent_url} about {endpoint}")
+                    self.logger.debug("✅ Notified agent %s about %s", agent_url, endpoint)
                 else:
                     self.logger.warning(f"⚠️ Agent {agent_url} returned {response.status_code}")
             except Exception as e:
-                self.logger.debug(f"🔇 Could not notify agent {agent_url}: {e}")    
+                self.logger.debug("🔇 Could not notify agent %s: %s", agent_url, e)    
 
     def get_file_status(self, file_path: str) -> dict:
 
@@ -1682,9 +2299,9 @@ class EventHandler:
             'description': 'Не отслеживается'
         }
         
-        # Проверяем прокомментированные файлы
-        if file_path in self.commented_files:
-            comment_info = self.commented_files[file_path]
+        # Проверяем прокомментированные файлы (одно чтение: запись может быть вытеснена в другом потоке)
+        comment_info = self._get_comment_info(file_path)
+        if comment_info is not None:
             status.update({
                 'status': 'commented',
                 'icon': '🟢',
@@ -1734,14 +2351,7 @@ class EventHandler:
                 self.logger.info(f"✅ Marked session as commented: {file_path} by {username}")
             
                 # Сохраняем информацию о прокомментированном файле
-                self.commented_files[file_path] = {
-                    'commented_at': datetime.now(),
-                    'username': username,
-                    'session_id': session_id,
-                    'content': comment_data.get('content', ''),
-                    'change_type': comment_data.get('change_type', 'other'),
-                    'created_at': comment_data.get('created_at', datetime.now().isoformat())
-                }
+                self.track_commented_file(file_path, username, session_id, comment_data)
             
                 # Закрываем все активные сессии для этого файла
                 closed_sessions = self.session_manager.close_all_sessions_for_file(file_path)
@@ -1753,27 +2363,64 @@ class EventHandler:
         except Exception as e:
             self.logger.error(f"❌ Error processing comment notification: {e}")
 
+    def track_commented_file(self, file_path: str, username: str, session_id: str, comment_data: dict):
+        """Запоминает прокомментированный файл, вытесняя самые старые и устаревшие записи"""
+        commented_at = datetime.now()
+        comment_info = {
+            'commented_at': commented_at,
+            'username': username,
+            'session_id': session_id,
+            'content': comment_data.get('content', ''),
+            'change_type': comment_data.get('change_type', 'other'),
+            # ISO-строка формируется только если сервер не передал время
+            'created_at': comment_data.get('created_at') or commented_at.isoformat()
+        }
+        
+        with self._commented_files_lock:
+            self.commented_files[file_path] = comment_info
+            self.commented_files.move_to_end(file_path)
+            
+            # Записи упорядочены по времени комментария - вытесняем с начала
+            expire_before = commented_at - self.commented_files_ttl
+            while self.commented_files:
+                oldest_info = next(iter(self.commented_files.values()))
+                if len(self.commented_files) <= self.commented_files_max and oldest_info['commented_at'] >= expire_before:
+                    break
+                self.commented_files.popitem(last=False)
+
+    def _get_comment_info(self, file_path: str) -> Optional[dict]:
+        """Возвращает запись о комментарии файла (None если ее нет или срок жизни истек)"""
+        with self._commented_files_lock:
+            comment_info = self.commented_files.get(file_path)
+            if comment_info is None:
+                return None
+            
+            if datetime.now() - comment_info['commented_at'] > self.commented_files_ttl:
+                del self.commented_files[file_path]
+                return None
+            return comment_info
+    
     def is_file_commented(self, file_path: str) -> bool:
-        """Проверяет был ли файл прокомментирован"""
-        return file_path in self.commented_files
+        """Проверяет был ли файл прокомментирован (с учетом времени жизни записи)"""
+        return self._get_comment_info(file_path) is not None
 
     def can_create_session_for_file(self, file_path: str, username: str) -> bool:
         """Проверяет можно ли создать сессию для файла"""
         # Не создаем сессии для прокомментированных файлов
         if self.is_file_commented(file_path):
-            self.logger.debug(f"🚫 Cannot create session for commented file: {file_path}")
+            self.logger.debug("🚫 Cannot create session for commented file: %s", file_path)
             return False
         
         # Проверяем есть ли прокомментированная сессия у этого пользователя
         if self.session_manager.is_session_commented(file_path, username):
-            self.logger.debug(f"🚫 User {username} has commented session for file: {file_path}")
+            self.logger.debug("🚫 User %s has commented session for file: %s", username, file_path)
             return False
     
         # Проверяем есть ли активная сессия у другого пользователя
         for session_key, session_data in self.session_manager.active_sessions.items():
             if (session_data['file_path'] == file_path and 
                     session_data['username'] != username):
-                self.logger.debug(f"👥 File {file_path} already has active session by {session_data['username']}")
+                self.logger.debug("👥 File %s already has active session by %s", file_path, session_data['username'])
                 return True  # Разрешаем многопользовательскую работу
     
         return True
@@ -1785,51 +2432,35 @@ class EventHandler:
         # Определяем основного редактора
         primary_editor = self._determine_primary_editor(file_path, username, current_editors)
     
-        # Вычисляем хеш если нужно
-        file_hash = None
-        if (self.config.get('hashing', {}).get('enabled', True) and
-            os.path.exists(file_path)):
-            file_hash = self.hash_calculator.calculate_file_hash_with_retry(file_path)
-    
-        # Принудительно создаем новую сессию (не используем smart_create_session)
-        session_data = self.session_manager._create_new_session(file_path, primary_editor, file_hash)
+        # Принудительно создаем новую сессию (не используем smart_create_session); хеш вычисляется в пуле
+        session_data = self.session_manager._create_new_session(file_path, primary_editor)
     
         # Добавляем информацию о со-редакторах в сессию
-        if len(current_editors) > 1:
-            session_data['co_editors'] = [editor for editor in current_editors if editor != primary_editor]
+        co_editors = [editor for editor in current_editors if editor != primary_editor]
+        is_multi_user = len(current_editors) > 1
+        if is_multi_user:
+            session_data['co_editors'] = co_editors
             session_data['is_multi_user'] = True
             self.logger.info(f"👥 Multi-user session created for commented file: {file_path}. Primary: {primary_editor}, Co-editors: {session_data['co_editors']}")
     
         self.stats['sessions_created'] += 1
     
-        event_data = {
-            'file_path': file_path,
-            'file_name': os.path.basename(file_path),
-            'event_type': 'created',
-            'file_hash': file_hash,
-            'user_id': primary_editor,
-            'session_id': session_data['session_id'],
-            'resume_count': 0,  # Всегда 0 для новых сессий после комментария
-            'is_multi_user': len(current_editors) > 1,
-            'co_editors': [editor for editor in current_editors if editor != primary_editor],
-            'is_new_after_comment': True,  # Флаг что это новая сессия после комментария
-            'source': 'server_agent',
-            'event_timestamp': datetime.now().isoformat()
-        }
+        # resume_count всегда 0 для новых сессий после комментария
+        event_data = self._build_event_data(file_path, 'created', session_data, primary_editor, current_editors,
+                                            co_editors=co_editors, resume_count=0, is_new_after_comment=True)
     
-        success = self.api_client.send_event(event_data)
-        if not success:
-            self.logger.error(f"Failed to send created event for commented file {file_path}: {event_data}")
-        return success
+        return self._send_event_hashed(event_data, session_data, f"Failed to send created event for commented file {file_path}: {event_data}")
     
     def get_session_status(self, file_path: str, username: str) -> dict:
         """Возвращает статус сессии для файла и пользователя"""
-        session_key = f"{file_path}:{username}"
+        session_data = self.session_manager.active_sessions.get(
+            self.session_manager._get_session_key(file_path, username)
+        )
     
-        if session_key in self.session_manager.active_sessions:
+        if session_data is not None:
             return {
                 "status": "active",
-                "session_data": self.session_manager.active_sessions[session_key]
+                "session_data": session_data
             }
         else:
             return {
@@ -1842,35 +2473,18 @@ class EventHandler:
         """Создает новую сессию без попытки возобновления"""
         primary_editor = self._determine_primary_editor(file_path, username, current_editors)
     
-        file_hash = None
-        if (self.config.get('hashing', {}).get('enabled', True) and
-            os.path.exists(file_path)):
-            file_hash = self.hash_calculator.calculate_file_hash_with_retry(file_path)
-    
-        # Принудительно создаем новую сессию
-        session_data = self.session_manager._create_new_session(file_path, primary_editor, file_hash)
+        # Принудительно создаем новую сессию (хеш вычисляется в пуле)
+        session_data = self.session_manager._create_new_session(file_path, primary_editor)
     
         # Добавляем информацию о со-редакторах
-        if len(current_editors) > 1:
-            session_data['co_editors'] = [editor for editor in current_editors if editor != primary_editor]
+        co_editors = [editor for editor in current_editors if editor != primary_editor]
+        is_multi_user = len(current_editors) > 1
+        if is_multi_user:
+            session_data['co_editors'] = co_editors
             session_data['is_multi_user'] = True
     
-        event_data = {
-            'file_path': file_path,
-            'file_name': os.path.basename(file_path),
-            'event_type': 'modified',
-            'file_hash': file_hash,
-            'user_id': primary_editor,
-            'session_id': session_data['session_id'],
-            'resume_count': 0,  # Всегда 0 для новой сессии
-            'is_multi_user': len(current_editors) > 1,
-            'co_editors': [editor for editor in current_editors if editor != primary_editor],
-            'is_new_session': True,  # Флаг что это новая сессия
-            'source': 'server_agent',
-            'event_timestamp': datetime.now().isoformat()
-        }
+        # resume_count всегда 0 для новой сессии
+        event_data = self._build_event_data(file_path, 'modified', session_data, primary_editor, current_editors,
+                                            co_editors=co_editors, resume_count=0, is_new_session=True)
     
-        success = self.api_client.send_event(event_data)
-        if not success:
-            self.logger.error(f"Failed to send modified event for {file_path}")
-        return success
\ No newline at end of file
+        return self._send_event_hashed(event_data, session_data, f"Failed to send modified event for {file_path}")
@@ -1,5 +1,7 @@
 # Эта файл оставлен как fallback для polling, но не используется по умолчанию на сервере
 import os
+import functools
+import re
 import time
 import threading
 from datetime import datetime
@@ -8,6 +10,21 @@ from shared.config_loader import get_monitoring_config
 from .event_handler import EventHandler
 from .background_checker import BackgroundSessionChecker
 
+def _compile_ignore_patterns(patterns):
+    """Собирает паттерны игнорирования каталогов в одно регулярное выражение (или None)"""
+    # '*abc' - окончание имени, 'abc*' - начало имени, иначе - вхождение подстроки
+    # (буквальное вхождение проверяется для любого паттерна, как и раньше)
+    fragments = []
+    for pattern in patterns:
+        if pattern.startswith('*'):
+            fragments.append(re.escape(pattern[1:]) + r'\Z')
+        elif pattern.endswith('*'):
+            fragments.append(r'\A' + re.escape(pattern[:-1]))
+        fragments.append(re.escape(pattern))
+    if not fragments:
+        return None
+    return re.compile('|'.join(f'(?:{fragment})' for fragment in fragments))
+
 class FileMonitor:
     def __init__(self, monitoring_config=None):
         if monitoring_config is None:
@@ -24,7 +41,8 @@ class FileMonitor:
         check_interval = self.config.get('background_check_interval', 15)
         self.background_checker = BackgroundSessionChecker(
             self.event_handler, 
-            check_interval=check_interval
+            check_interval=check_interval,
+            orphan_check_interval=self.config.get('orphan_check_interval', 60)
         )
         
         # Флаг работы
@@ -37,8 +55,16 @@ class FileMonitor:
         # watch_paths теперь локальные
         self.watch_paths = self.config.get('watch_paths', ['C:\\SharedFolder'])
         
+        # Правила игнорирования директорий читаются из конфигурации один раз
+        self.ignore_dirs = frozenset(self.config.get('ignore_dirs', []))
+        self.ignore_patterns = tuple(self.config.get('ignore_patterns', []))
+        self._ignore_re = _compile_ignore_patterns(self.ignore_patterns)
+        # Решение зависит только от имени каталога и неизменной конфигурации: имена повторяются
+        # в каждом цикле опроса, поэтому проверка паттернов выполняется один раз на имя
+        self._should_ignore_dir = functools.lru_cache(maxsize=4096)(self._should_ignore_dir)
+        
         # Трекер состояния файлов
-        self.file_states = {}  # file_path -> (mtime, size)
+        self.file_states = {}  # dir_path -> {file_name: (mtime, size)}
         
         self.logger.info(f"🎯 FileMonitor initialized with process-based scanning every {self.scan_interval}s (fallback mode)")
 
@@ -78,12 +104,12 @@ class FileMonitor:
                 
                 # Детальная информация об активных сессиях
                 if active_sessions > 0:
-                    timeout_minutes = self.event_handler.session_manager.config.get('session_timeout_minutes', 30)
+                    timeout_seconds = self.event_handler.session_manager.timeout_seconds
                     for session_key, session_data in self.event_handler.session_manager.active_sessions.items():
                         last_activity = session_data['last_activity']
                         time_since_activity = datetime.now() - last_activity
-                        remaining = (timeout_minutes * 60) - time_since_activity.total_seconds()
-                        self.logger.debug(f"⏰ {session_key}: inactive {time_since_activity.total_seconds():.1f}s (expires in {remaining:.1f}s)")
+                        remaining = timeout_seconds - time_since_activity.total_seconds()
+                        self.logger.debug("⏰ %s: inactive %.1fs (expires in %.1fs)", session_key, time_since_activity.total_seconds(), remaining)
                 
         except KeyboardInterrupt:
             self.stop()
@@ -115,89 +141,125 @@ class FileMonitor:
                 self.logger.warning(f"Watch path does not exist: {watch_path}")
                 continue
                 
-            for root, dirs, files in os.walk(watch_path):
-                # Пропускаем игнорируемые директории
-                dirs[:] = [d for d in dirs if not self._should_ignore_dir(os.path.join(root, d))]
-                
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    if self.event_handler.file_validator.should_monitor_file(file_path):
-                        try:
-                            stat = os.stat(file_path)
-                            self.file_states[file_path] = (stat.st_mtime, stat.st_size)
-                            self.logger.debug(f"📁 Tracked existing file: {file_path}")
-                        except (OSError, PermissionError) as e:
-                            self.logger.debug(f"Could not access file {file_path}: {e}")
+            for dir_path, files in self._iter_dirs(watch_path):
+                if not files:
+                    continue
+                dir_states = self.file_states.setdefault(dir_path, {})
+                for file_name, stat in files:
+                    dir_states[file_name] = (stat.st_mtime, stat.st_size)
+                    self.logger.debug("📁 Tracked existing file: %s", os.path.join(dir_path, file_name))
 
     def _scan_files(self):
-        """Сканирует файлы на изменения"""
-        current_files = set()
+        """Сканирует файлы на изменения, обрабатывая дерево по одному каталогу"""
+        scanned_dirs = set()
         
         for watch_path in self.watch_paths:
             if not os.path.exists(watch_path):
                 continue
                 
-            for root, dirs, files in os.walk(watch_path):
-                # Пропускаем игнорируемые директории
-                dirs[:] = [d for d in dirs if not self._should_ignore_dir(os.path.join(root, d))]
+            for dir_path, files in self._iter_dirs(watch_path):
+                scanned_dirs.add(dir_path)
+                for file_name, stat in files:
+                    self._check_file_changes(dir_path, file_name, stat)
                 
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    
-                    if not self.event_handler.file_validator.should_monitor_file(file_path):
-                        continue
-                        
-                    current_files.add(file_path)
-                    self._check_file_changes(file_path)
+                # Удаления считаются сразу после каталога: разность ограничена его размером
+                self._check_deleted_files(dir_path, {file_name for file_name, _ in files})
         
-        # Проверяем удаленные файлы
-        self._check_deleted_files(current_files)
+        # Каталоги, которые не встретились при обходе, удалены целиком
+        for dir_path in self.file_states.keys() - scanned_dirs:
+            self._check_deleted_files(dir_path, ())
+
+    def _iter_dirs(self, watch_path):
+        """Обходит дерево через os.scandir и по одному каталогу возвращает (каталог, [(имя, stat), ...])"""
+        # Тип записи берется из readdir, а stat - из той же записи (на Windows без
+        # дополнительного запроса к серверу), вместо listdir + stat в os.walk.
+        # В памяти одновременно находится только один каталог, а не все дерево
+        should_monitor_file = self.event_handler.file_validator.should_monitor_file
+        stack = [watch_path]
+        while stack:
+            dir_path = stack.pop()
+            files = []
+            try:
+                with os.scandir(dir_path) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                if not self._should_ignore_dir(entry.name):
+                                    stack.append(entry.path)
+                            elif entry.is_file():
+                                stat = entry.stat()
+                                if should_monitor_file(entry.path, stat):
+                                    files.append((entry.name, stat))
+                        except OSError as e:
+                            self.logger.debug("Could not access file %s: %s", entry.path, e)
+            except OSError as e:
+                self.logger.debug("Could not scan directory %s: %s", dir_path, e)
+                continue
+            yield dir_path, files
 
-    def _check_file_changes(self, file_path):
-        """Проверяет изменения файла"""
+    def _check_file_changes(self, dir_path, file_name, current_stat=None):
+        """Проверяет изменения файла (stat можно передать из обхода каталога)"""
+        file_path = os.path.join(dir_path, file_name)
         try:
-            if not os.path.exists(file_path):
-                return
-                
-            current_stat = os.stat(file_path)
+            if current_stat is None:
+                # Один stat вместо exists + stat: отсутствие файла видно по исключению
+                try:
+                    current_stat = os.stat(file_path)
+                except FileNotFoundError:
+                    return
             current_mtime = current_stat.st_mtime
             current_size = current_stat.st_size
             
-            previous_state = self.file_states.get(file_path)
+            dir_states = self.file_states.get(dir_path)
+            previous_state = dir_states.get(file_name) if dir_states else None
             
             if previous_state is None:
                 # Новый файл
                 self.logger.info(f"🆕 New file detected: {file_path}")
-                self._process_file_event(file_path, 'created', current_mtime, current_size)
+                self._process_file_event(dir_path, file_name, 'created', current_mtime, current_size)
             else:
                 prev_mtime, prev_size = previous_state
                 
                 if current_mtime != prev_mtime:
                     if current_size != prev_size:
                         # Файл изменен
-                        self.logger.debug(f"📝 File modified: {file_path}")
-                        self._process_file_event(file_path, 'modified', current_mtime, current_size)
+                        self.logger.debug("📝 File modified: %s", file_path)
+                        self._process_file_event(dir_path, file_name, 'modified', current_mtime, current_size)
                     else:
                         # Изменены только метаданные
-                        self.file_states[file_path] = (current_mtime, current_size)
+                        dir_states[file_name] = (current_mtime, current_size)
                         
         except (OSError, PermissionError) as e:
-            self.logger.debug(f"Could not access file {file_path}: {e}")
+            self.logger.debug("Could not access file %s: %s", file_path, e)
 
-    def _check_deleted_files(self, current_files):
-        """Проверяет удаленные файлы"""
-        deleted_files = set(self.file_states.keys()) - current_files
+    def _check_deleted_files(self, dir_path, current_names):
+        """Проверяет удаленные файлы каталога"""
+        dir_states = self.file_states.get(dir_path)
+        if not dir_states:
+            return
+        
+        # Разность считается по представлению ключей, без промежуточной копии в set
+        deleted_names = dir_states.keys() - current_names
+        if not deleted_names:
+            return
         
-        for file_path in deleted_files:
+        for file_name in deleted_names:
+            file_path = os.path.join(dir_path, file_name)
             if self.event_handler.file_validator.should_monitor_file_by_name(file_path):
                 self.logger.info(f"🗑️ File deleted: {file_path}")
-                self._process_file_event(file_path, 'deleted')
-            # Удаляем из состояния в любом случае
-            if file_path in self.file_states:
-                del self.file_states[file_path]
+                self._process_file_event(dir_path, file_name, 'deleted')
+        
+        # Удаляем из состояния в любом случае: одна пересборка словаря вместо del по каждому ключу
+        remaining = {file_name: state for file_name, state in dir_states.items()
+                     if file_name not in deleted_names}
+        if remaining:
+            self.file_states[dir_path] = remaining
+        else:
+            self.file_states.pop(dir_path, None)
 
-    def _process_file_event(self, file_path, event_type, mtime=None, size=None):
+    def _process_file_event(self, dir_path, file_name, event_type, mtime=None, size=None):
         """Обрабатывает событие файла"""
+        file_path = os.path.join(dir_path, file_name)
         try:
             # Обрабатываем событие через event_handler
             success = self.event_handler.handle_file_event(event_type, file_path)
@@ -208,30 +270,18 @@ class FileMonitor:
                     stat = os.stat(file_path)
                     mtime, size = stat.st_mtime, stat.st_size
                 
-                self.file_states[file_path] = (mtime, size)
+                self.file_states.setdefault(dir_path, {})[file_name] = (mtime, size)
                 
         except Exception as e:
             self.logger.error(f"Error processing {event_type} event for {file_path}: {e}")
 
-    def _should_ignore_dir(self, dir_path):
-        """Проверяет нужно ли игнорировать директорию"""
-        dir_name = os.path.basename(dir_path)
-        ignore_dirs = self.config.get('ignore_dirs', [])
-        
-        if dir_name in ignore_dirs:
+    def _should_ignore_dir(self, dir_name):
+        """Проверяет нужно ли игнорировать директорию (по имени)"""
+        if dir_name in self.ignore_dirs:
             return True
             
-        # Проверяем паттерны
-        ignore_patterns = self.config.get('ignore_patterns', [])
-        for pattern in ignore_patterns:
-            if pattern.startswith('*') and dir_name.endswith(pattern[1:]):
-                return True
-            elif pattern.endswith('*') and dir_name.startswith(pattern[:-1]):
-                return True
-            elif pattern in dir_name:
-                return True
-                
-        return False
+        # Все паттерны проверяются одним поиском по скомпилированному выражению
+        return self._ignore_re is not None and self._ignore_re.search(dir_name) is not None
 
     def stop(self):
         """Останавливает мониторинг"""
@@ -1,17 +1,41 @@
 import os
 import fnmatch
 import re
+from collections import OrderedDict
 from typing import List
 from shared.logger import setup_logger
 
+# Расширенные паттерны временных файлов (проверяются без учета регистра)
+_EXTENDED_TEMP_RE = re.compile('|'.join(f'(?:{pattern})' for pattern in (
+    # Файлы без расширения с HEX-именами (типичные временные файлы)
+    r'^[0-9A-F]{4,16}$',
+    r'^[0-9A-F]{4,16}\.tmp$',
+    r'^[0-9A-F]{4,16}\.temp$',
+    # Файлы с короткими именами (часто временные)
+    r'^[A-Z0-9]{4,8}$',
+    r'^[A-Z0-9]{4,8}\.tmp$',
+)), re.IGNORECASE)
+
+# Специфические паттерны для разных приложений (проверяются по имени в нижнем регистре)
+_SPECIFIC_TEMP_RE = re.compile('|'.join(f'(?:{pattern})' for pattern in (
+    r'~wrl\d+\.tmp',      # Word
+    r'~wrd\d+\.tmp',      # Word
+    r'~rf.*\.tmp',        # Excel
+    r'.*\.tmp\..*',       # Файлы с двойными расширениями
+    r'^~\$.*',            # Автосохранение Office
+    # Дополнительные паттерны для Excel/Word временных файлов
+    r'^[A-F0-9]{8}\.tmp$',  # E3327DC9.tmp и подобные
+    r'^[A-F0-9]{8}$',       # C1EE4200 и подобные (без расширения)
+)))
+
 class FileValidator:
     def __init__(self, config: dict):
         self.config = config
         self.logger = setup_logger(__name__)
 
-        # ОГРАНИЧЕНИЕ РАЗМЕРА КЭША
-        self._category_cache = {}
-        self._max_cache_size = 1000  # Максимальный размер кэша
+        # ОГРАНИЧЕНИЕ РАЗМЕРА КЭША: LRU по имени файла (категория зависит только от имени)
+        self._category_cache = OrderedDict()
+        self._max_cache_size = self.config.get('category_cache_size', 4096)
         self._cache_hits = 0
         self._cache_misses = 0
         
@@ -80,19 +104,17 @@ class FileValidator:
         self.ignore_extensions = self.config.get('ignore_extensions', [])
         self.ignore_dirs = self.config.get('ignore_dirs', [])
         
-        # ДОБАВЛЕНО: Кэш для быстрого определения категорий
-        self._category_cache = {}
-        
-        # ДОБАВЛЕНО: Расширенные паттерны для временных файлов
-        self._extended_temp_patterns = [
-            # Файлы без расширения с HEX-именами (типичные временные файлы)
-            r'^[0-9A-F]{4,16}$',
-            r'^[0-9A-F]{4,16}\.tmp$',
-            r'^[0-9A-F]{4,16}\.temp$',
-            # Файлы с короткими именами (часто временные)
-            r'^[A-Z0-9]{4,8}$',
-            r'^[A-Z0-9]{4,8}\.tmp$',
-        ]
+        # Проверки по пути не зависят от содержимого файла: множества для O(1) поиска
+        # и LRU-кэш решений по директориям
+        self._ignore_extensions_set = frozenset(self.ignore_extensions)
+        self._ignore_dir_names = frozenset(os.path.normpath(d).lower() for d in self.ignore_dirs)
+        self._ignored_dir_cache = OrderedDict()
+        
+        # Базовые паттерны TEMPORARY не содержат '*', поэтому _matches_pattern
+        # сводится к точному совпадению имени - проверяем по множеству
+        self._temporary_names = frozenset(self.FILE_CATEGORIES['TEMPORARY'])
+        self._main_extensions = frozenset(self.FILE_CATEGORIES['MAIN'])
+        self._office_default_names = frozenset(self.OFFICE_DEFAULT_NAMES)
         
         self.logger.info(f"✅ FileValidator initialized with {len(self.FILE_CATEGORIES['MAIN'])} main formats, "
                         f"{len(self.FILE_CATEGORIES['TEMPORARY'])} temporary patterns, "
@@ -102,62 +124,66 @@ class FileValidator:
         """Определяет категорию файла"""
         filename = os.path.basename(file_path)
         
-        # ОЧИСТКА КЭША ПРИ ПРЕВЫШЕНИИ ЛИМИТА
-        if len(self._category_cache) > self._max_cache_size:
-            self._category_cache.clear()
-            self.logger.debug("🧹 Cleared category cache (size limit exceeded)")
-        
-        if file_path in self._category_cache:
+        category = self._category_cache.get(filename)
+        if category is not None:
             self._cache_hits += 1
-            return self._category_cache[file_path]
+            try:
+                self._category_cache.move_to_end(filename)
+            except KeyError:
+                pass  # запись вытеснена другим потоком
+            return category
     
         self._cache_misses += 1
+        category = self._classify_filename(filename)
         
-        
+        # Вытесняем самую давно использованную запись вместо полной очистки кэша
+        self._category_cache[filename] = category
+        if len(self._category_cache) > self._max_cache_size:
+            self._category_cache.popitem(last=False)
+        return category
+
+    def _classify_filename(self, filename: str) -> str:
+        """Вычисляет категорию по имени файла (без кэша)"""
         # 1. Проверяем полностью игнорируемые файлы
         if self._is_ignored_file(filename):
-            self._category_cache[file_path] = 'IGNORE'
             return 'IGNORE'
         
         # 2. Проверяем временные файлы (включая расширенные паттерны)
         if self._is_temporary_file(filename):
-            self._category_cache[file_path] = 'TEMPORARY'
             return 'TEMPORARY'
         
         # 3. Проверяем основные файлы
         file_ext = os.path.splitext(filename)[1].lower()
-        if file_ext in self.FILE_CATEGORIES['MAIN']:
-            self._category_cache[file_path] = 'MAIN'
+        if file_ext in self._main_extensions:
             return 'MAIN'
         
         # 4. Файл не подходит ни под одну категорию - считаем IGNORE
-        self._category_cache[file_path] = 'IGNORE'
         return 'IGNORE'
 
     def is_office_default_name(self, file_path: str) -> bool:
         """Проверяет является ли файл стандартным именем Office"""
         filename = os.path.basename(file_path).lower()
-        return filename in self.OFFICE_DEFAULT_NAMES
+        return filename in self._office_default_names
 
-    def should_monitor_file(self, file_path: str) -> bool:
-        """Определяет нужно ли отслеживать файл"""
-        if not os.path.isfile(file_path):
+    def should_monitor_file(self, file_path: str, stat_result: os.stat_result = None) -> bool:
+        """Определяет нужно ли отслеживать файл (stat_result - уже полученный stat обычного файла)"""
+        if stat_result is None and not os.path.isfile(file_path):
             return False
         
         # Используем универсальную классификацию
         file_category = self.get_file_category(file_path)
         
         if file_category == 'IGNORE':
-            self.logger.debug(f"🚫 Ignoring file (category: IGNORE): {os.path.basename(file_path)}")
+            self.logger.debug("🚫 Ignoring file (category: IGNORE): %s", os.path.basename(file_path))
             return False
         
         if file_category == 'TEMPORARY':
-            self.logger.debug(f"⏰ Temporary file, monitoring for context: {os.path.basename(file_path)}")
+            self.logger.debug("⏰ Temporary file, monitoring for context: %s", os.path.basename(file_path))
             return True  # Отслеживаем для контекста, но не создаем сессии
         
         if file_category == 'MAIN':
             # Дополнительные проверки для основных файлов
-            if not self._passes_additional_checks(file_path):
+            if not self._passes_additional_checks(file_path, stat_result):
                 return False
             return True
         
@@ -171,11 +197,11 @@ class FileValidator:
         file_category = self.get_file_category(file_path)
         
         if file_category == 'IGNORE':
-            self.logger.debug(f"🚫 Ignoring deleted file (category: IGNORE): {filename}")
+            self.logger.debug("🚫 Ignoring deleted file (category: IGNORE): %s", filename)
             return False
         
         if file_category == 'TEMPORARY':
-            self.logger.debug(f"⏰ Deleted temporary file: {filename}")
+            self.logger.debug("⏰ Deleted temporary file: %s", filename)
             return True
         
         if file_category == 'MAIN':
@@ -204,30 +230,12 @@ class FileValidator:
         filename_lower = filename.lower()
         
         # Проверяем базовые паттерны TEMPORARY
-        for pattern in self.FILE_CATEGORIES['TEMPORARY']:
-            if self._matches_pattern(filename_lower, pattern):
-                return True
-        
-        # Проверяем расширенные паттерны для временных файлов
-        for pattern in self._extended_temp_patterns:
-            if re.match(pattern, filename, re.IGNORECASE):
-                return True
-        
-        # Специфические паттерны для разных приложений
-        specific_temp_patterns = [
-            r'~wrl\d+\.tmp',      # Word
-            r'~wrd\d+\.tmp',      # Word  
-            r'~rf.*\.tmp',        # Excel
-            r'.*\.tmp\..*',       # Файлы с двойными расширениями
-            r'^~\$.*',            # Автосохранение Office
-            # Дополнительные паттерны для Excel/Word временных файлов
-            r'^[A-F0-9]{8}\.tmp$',  # E3327DC9.tmp и подобные
-            r'^[A-F0-9]{8}$',       # C1EE4200 и подобные (без расширения)
-        ]
+        if filename_lower in self._temporary_names:
+            return True
         
-        for pattern in specific_temp_patterns:
-            if re.match(pattern, filename_lower):
-                return True
+        # Расширенные и специфические паттерны - по одному проходу скомпилированного regex
+        if _EXTENDED_TEMP_RE.match(filename) or _SPECIFIC_TEMP_RE.match(filename_lower):
+            return True
         
         # Проверяем файлы без расширения с короткими именами (часто временные)
         name_without_ext = os.path.splitext(filename)[0]
@@ -267,26 +275,26 @@ class FileValidator:
         except re.error:
             return False
 
-    def _passes_additional_checks(self, file_path: str) -> bool:
+    def _passes_additional_checks(self, file_path: str, stat_result: os.stat_result = None) -> bool:
         """Дополнительные проверки для основных файлов"""
         filename = os.path.basename(file_path)
         
         # Проверяем игнорируемые расширения из конфига
         file_ext = os.path.splitext(filename)[1].lower()
-        if file_ext in self.ignore_extensions:
-            self.logger.debug(f"Ignoring file due to extension: {filename}")
+        if file_ext in self._ignore_extensions_set:
+            self.logger.debug("Ignoring file due to extension: %s", filename)
             return False
         
         # Проверяем игнорируемые директории в пути
         if self._contains_ignore_dirs(file_path):
-            self.logger.debug(f"Ignoring file in excluded directory: {file_path}")
+            self.logger.debug("Ignoring file in excluded directory: %s", file_path)
             return False
         
         # Проверяем размер файла (игнорируем слишком маленькие файлы)
         try:
-            file_size = os.path.getsize(file_path)
+            file_size = stat_result.st_size if stat_result is not None else os.path.getsize(file_path)
             if file_size < 10:  # Игнорируем файлы меньше 10 байт
-                self.logger.debug(f"Ignoring too small file: {filename} ({file_size} bytes)")
+                self.logger.debug("Ignoring too small file: %s (%s bytes)", filename, file_size)
                 return False
         except (OSError, ValueError):
             pass
@@ -295,20 +303,22 @@ class FileValidator:
 
     def _contains_ignore_dirs(self, file_path: str) -> bool:
         """Проверяет содержит ли путь игнорируемые директории"""
-        if not self.ignore_dirs:
+        if not self._ignore_dir_names:
             return False
         
         # Нормализуем путь для кроссплатформенности
-        normalized_path = os.path.normpath(file_path).lower()
-        path_parts = normalized_path.split(os.sep)
-        
-        for ignore_dir in self.ignore_dirs:
-            ignore_dir_normalized = os.path.normpath(ignore_dir).lower()
-            # Проверяем, содержится ли игнорируемая директория в пути
-            if ignore_dir_normalized in path_parts:
-                return True
+        dir_path, filename = os.path.split(os.path.normpath(file_path).lower())
+        if filename in self._ignore_dir_names:
+            return True
         
-        return False
+        # Решение для директории кэшируется: события идут пачками из одних и тех же папок
+        ignored = self._ignored_dir_cache.get(dir_path)
+        if ignored is None:
+            ignored = not self._ignore_dir_names.isdisjoint(dir_path.split(os.sep))
+            self._ignored_dir_cache[dir_path] = ignored
+            if len(self._ignored_dir_cache) > self._max_cache_size:
+                self._ignored_dir_cache.popitem(last=False)
+        return ignored
 
     def get_monitorable_files(self, directory: str) -> List[str]:
         """Возвращает список файлов для мониторинга в директории"""
@@ -355,4 +365,5 @@ class FileValidator:
 
     def clear_cache(self):
         """Очищает кэш категорий"""
-        self._category_cache.clear()
\ No newline at end of file
+        self._category_cache.clear()
+        self._ignored_dir_cache.clear()
\ No newline at end of file
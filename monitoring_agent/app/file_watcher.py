@@ -16,22 +16,22 @@ class FileMonitorHandler(FileSystemEventHandler):
     
     def on_created(self, event):
         if not event.is_directory:
-            self.logger.debug(f"File created: {event.src_path}")
+            self.logger.debug("File created: %s", event.src_path)
             self.event_handler.handle_file_event('created', event.src_path)
     
     def on_modified(self, event):
         if not event.is_directory:
-            self.logger.debug(f"File modified: {event.src_path}")
+            self.logger.debug("File modified: %s", event.src_path)
             self.event_handler.handle_file_event('modified', event.src_path)
     
     def on_deleted(self, event):
         if not event.is_directory:
-            self.logger.debug(f"File deleted: {event.src_path}")
+            self.logger.debug("File deleted: %s", event.src_path)
             self.event_handler.handle_file_event('deleted', event.src_path)
     
     def on_moved(self, event):
         if not event.is_directory:
-            self.logger.debug(f"File moved: {event.src_path} -> {event.dest_path}")
+            self.logger.debug("File moved: %s -> %s", event.src_path, event.dest_path)
             self.event_handler.handle_file_event('moved', event.src_path, event.dest_path)
 
 class FileWatcher:
@@ -55,12 +55,17 @@ class FileWatcher:
         # Инициализируем обработчик событий
         self.event_handler = EventHandler(monitoring_config=self.config)
         self.monitor_handler = FileMonitorHandler(self.event_handler)
+        # Состояние EventHandler (сессии, цепочки перемещений, stats) не защищено для
+        # параллельных обработчиков: события обрабатываются одним потоком watchdog
+        if self.config.get('event_workers', 1) != 1:
+            self.logger.warning("⚠️ event_workers is not supported (events are handled by a single thread), ignoring")
         
         # Создаем фоновый проверщик сессий
         check_interval = self.config.get('background_check_interval', 15)
         self.background_checker = BackgroundSessionChecker(
             self.event_handler, 
-            check_interval=check_interval
+            check_interval=check_interval,
+            orphan_check_interval=self.config.get('orphan_check_interval', 60)
         )
         
         self.logger.info(f"🎯 FileWatcher initialized with background checking every {check_interval}s")
@@ -107,12 +112,12 @@ class FileWatcher:
                 
                 # Детальная информация об активных сессиях
                 if active_sessions > 0:
-                    timeout_minutes = self.event_handler.session_manager.config.get('session_timeout_minutes', 30)
+                    timeout_seconds = self.event_handler.session_manager.timeout_seconds
                     for session_key, session_data in self.event_handler.session_manager.active_sessions.items():
                         last_activity = session_data['last_activity']
                         time_since_activity = datetime.now() - last_activity
-                        remaining = (timeout_minutes * 60) - time_since_activity.total_seconds()
-                        self.logger.debug(f"⏰ {session_key}: inactive {time_since_activity.total_seconds():.1f}s (expires in {remaining:.1f}s)")
+                        remaining = timeout_seconds - time_since_activity.total_seconds()
+                        self.logger.debug("⏰ %s: inactive %.1fs (expires in %.1fs)", session_key, time_since_activity.total_seconds(), remaining)
                 
         except KeyboardInterrupt:
             self.stop()
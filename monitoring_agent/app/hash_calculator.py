@@ -1,14 +1,54 @@
 # hash_calculator.py
 import hashlib
+import mmap
 import os
 import time  # For retry
 from typing import Optional
 from shared.logger import setup_logger
 
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+# Подсказки ядру о последовательном чтении (Linux/POSIX; на Windows отсутствуют)
+_MADV_SEQUENTIAL = getattr(mmap, 'MADV_SEQUENTIAL', None)
+_posix_fadvise = getattr(os, 'posix_fadvise', None)
+_FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', None)
+
+# На Windows файл с открытым отображением нельзя усечь (ERROR_USER_MAPPED_FILE):
+# Office/CAD не смогли бы сохранить файл, пока агент его хеширует
+_USE_MMAP = os.name != 'nt'
+
+# ERROR_SHARING_VIOLATION, ERROR_LOCK_VIOLATION
+_LOCK_WINERRORS = (32, 33)
+
+def _is_lock_error(e: Exception) -> bool:
+    """Файл заблокирован другим процессом или недоступен по правам"""
+    return isinstance(e, PermissionError) or getattr(e, 'winerror', None) in _LOCK_WINERRORS
+
 class HashCalculator:
     def __init__(self, config: dict):
         self.config = config
         self.logger = setup_logger(__name__)
+        
+        # sha256 через hashlib использует OpenSSL (SHA-NI на современных CPU);
+        # blake3 доступен опционально, но меняет значения хешей на сервере
+        self.hash_method = self.config.get('method', 'sha256')
+        if self.hash_method == 'blake3' and blake3 is None:
+            self.logger.warning("blake3 is not installed, falling back to sha256")
+            self.hash_method = 'sha256'
+        
+        # Крупные блоки чтения: накладные расходы Python на каждый блок доминируют над хешированием
+        self.chunk_size = self.config.get('chunk_size_kb', 1024) * 1024
+        # Файлы меньше порога читаются одним вызовом read() без буфера
+        self.small_file_size = self.config.get('small_file_size_kb', 64) * 1024
+    
+    def _new_hasher(self):
+        """Создает объект хеширования для настроенного алгоритма"""
+        if self.hash_method == 'blake3':
+            return blake3.blake3()
+        return hashlib.new(self.hash_method)
     
     def calculate_file_hash_with_retry(self, file_path: str, max_retries=3, delay=1) -> Optional[str]:
         """Вычисляет хеш файла с retry для locked файлов"""
@@ -16,7 +56,7 @@ class HashCalculator:
             try:
                 return self.calculate_file_hash(file_path)
             except Exception as e:
-                if 'locked' in str(e) or 'permission' in str(e).lower():  # Rough check for locked
+                if _is_lock_error(e):
                     self.logger.warning(f"File {file_path} locked, retry {attempt+1}/{max_retries}")
                     time.sleep(delay)
                 else:
@@ -26,39 +66,75 @@ class HashCalculator:
     def calculate_file_hash(self, file_path: str) -> Optional[str]:
         """Вычисляет хеш файла с учетом ограничений по размеру"""
         try:
-            if not os.path.exists(file_path):
+            # Один stat вместо exists + getsize
+            try:
+                file_size = os.stat(file_path).st_size
+            except FileNotFoundError:
                 return None
             
-            file_size = os.path.getsize(file_path)
             max_size_mb = self.config.get('max_file_size_mb', 50)
             
             if file_size > max_size_mb * 1024 * 1024:
                 # Для больших файлов используем частичное хеширование
-                return self._calculate_partial_hash(file_path)
+                return self._calculate_partial_hash(file_path, file_size)
             else:
                 # Для маленьких файлов - полное хеширование
-                return self._calculate_full_hash(file_path)
+                return self._calculate_full_hash(file_path, file_size)
                 
         except Exception as e:
             self.logger.error(f"Error calculating hash for {file_path}: {e}")
             raise
     
-    def _calculate_full_hash(self, file_path: str) -> str:
+    def _calculate_full_hash(self, file_path: str, file_size: Optional[int] = None) -> str:
         """Вычисляет полный хеш файла"""
-        hash_method = self.config.get('method', 'sha256')
-        hasher = hashlib.new(hash_method)
+        hasher = self._new_hasher()
         
-        with open(file_path, 'rb') as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hasher.update(chunk)
+        if file_size is not None and file_size <= self.small_file_size:
+            # Маленький файл: одно чтение, без выделения буфера на chunk_size
+            with open(file_path, 'rb', buffering=0) as f:
+                data = f.read()
+            hasher.update(data)
+            return hasher.hexdigest()
+        
+        if _USE_MMAP and file_size is not None and file_size > self.chunk_size:
+            # Файл отображается в память: хешер читает страницы из page cache
+            # без копирования в буферы Python и одним вызовом (GIL отпущен)
+            try:
+                with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    if _MADV_SEQUENTIAL is not None:
+                        # Агрессивный readahead и раннее освобождение прочитанных страниц
+                        mapped.madvise(_MADV_SEQUENTIAL)
+                    hasher.update(mapped)
+                return hasher.hexdigest()
+            except (ValueError, OSError) as e:
+                if _is_lock_error(e):
+                    raise
+                self.logger.debug("mmap unavailable for %s, using buffered read: %s", file_path, e)
+                hasher = self._new_hasher()
+        
+        # Буфер не больше самого файла
+        buffer = bytearray(min(self.chunk_size, file_size or self.chunk_size))
+        view = memoryview(buffer)
+        
+        with open(file_path, 'rb', buffering=0) as f:
+            if _posix_fadvise is not None:
+                try:
+                    _posix_fadvise(f.fileno(), 0, 0, _FADV_SEQUENTIAL)
+                except OSError:
+                    pass  # подсказка необязательна (например, для сетевых ФС)
+            while True:
+                read = f.readinto(buffer)
+                if not read:
+                    break
+                hasher.update(view[:read])
         
         return hasher.hexdigest()
     
-    def _calculate_partial_hash(self, file_path: str) -> str:
+    def _calculate_partial_hash(self, file_path: str, file_size: Optional[int] = None) -> str:
         """Вычисляет частичный хеш для больших файлов"""
-        hash_method = self.config.get('method', 'sha256')
-        hasher = hashlib.new(hash_method)
-        file_size = os.path.getsize(file_path)
+        hasher = self._new_hasher()
+        if file_size is None:
+            file_size = os.path.getsize(file_path)
         
         with open(file_path, 'rb') as f:
             # Хешируем начало файла (первые 64KB)
@@ -12,6 +12,11 @@ from shared.config_loader import load_config, get_monitoring_config
 from shared.logger import setup_logger
 from monitoring_agent.app.file_monitor import FileMonitor
 
+try:
+    from monitoring_agent.app.file_watcher import FileWatcher
+except ImportError:
+    FileWatcher = None
+
 def main():
     """Главная функция запуска агента мониторинга"""
     logger = setup_logger(__name__)
@@ -37,8 +42,18 @@ def main():
                 os.makedirs(path, exist_ok=True)
                 logger.info(f"Created watch path: {path}")
         
-        # Создаем и запускаем монитор
-        monitor = FileMonitor(monitoring_config=monitoring_config)
+        # Создаем и запускаем монитор: уведомления ОС (ReadDirectoryChangesW/inotify через watchdog)
+        # вместо периодического обхода дерева; polling остается как fallback
+        mode = monitoring_config.get('mode', 'watchdog')
+        if mode == 'watchdog' and FileWatcher is None:
+            logger.warning("watchdog is not installed, falling back to polling mode")
+            mode = 'polling'
+        
+        if mode == 'watchdog':
+            monitor = FileWatcher(monitoring_config=monitoring_config)
+        else:
+            monitor = FileMonitor(monitoring_config=monitoring_config)
+        logger.info(f"Monitoring mode: {mode}")
         monitor.start()
         
     except KeyboardInterrupt:
@@ -1,28 +1,63 @@
 # session_manager.py
 import os
+import heapq
+import threading
 import uuid
 from datetime import datetime, timedelta
-from typing import Dict, Optional, List
+from typing import Dict, Optional, List, Tuple
 from shared.logger import setup_logger
 
 class SessionManager:
     def __init__(self):
-        self.active_sessions: Dict[str, Dict] = {}  # file_path:username -> session_data
-        self.closed_sessions: Dict[str, List[Dict]] = {}  # История закрытых сессий
+        self.active_sessions: Dict[Tuple[str, str], Dict] = {}  # (file_path, username) -> session_data
+        self.closed_sessions: Dict[Tuple[str, str], List[Dict]] = {}  # История закрытых сессий
         self.logger = setup_logger(__name__)
         self.config = {}
+        self.timeout_seconds = 30 * 60
+        self.max_age_seconds = 3 * 3600
+        
+        # Мин-куча (срок истечения, ключ сессии) - проверяем только сессии, чей срок наступил.
+        # Записи инвалидируются лениво: при извлечении срок пересчитывается по актуальным данным
+        self._expiry_heap: List[Tuple[float, Tuple[str, str]]] = []
+        self._expiry_lock = threading.Lock()
     
     def set_config(self, config: dict):
         """Устанавливает конфигурацию"""
         self.config = config
         timeout = self.config.get('session_timeout_minutes', 30)
+        # Пороги в секундах вычисляются один раз - они нужны на каждую проверку истечения
+        self.timeout_seconds = timeout * 60
+        self.max_age_seconds = self.config.get('max_session_hours', 3) * 3600
         self.logger.info(f"⚙️ Session config: timeout={timeout}min, max_age={self.config.get('max_session_hours', 3)}h")
     
-    def _get_session_key(self, file_path: str, username: str) -> str:
-        """Генерирует ключ сессии"""
-        return f"{file_path}:{username}"
+    def _get_session_key(self, file_path: str, username: str) -> Tuple[str, str]:
+        """Генерирует ключ сессии (кортеж - без построения строки на каждый поиск)"""
+        return (file_path, username)
+    
+    def has_active_session(self, file_path: str, username: str) -> bool:
+        """Проверяет есть ли активная сессия (без обновления активности)"""
+        return (file_path, username) in self.active_sessions
+    
+    def _get_expiry_deadline(self, session_data: Dict) -> float:
+        """Возвращает момент истечения сессии (timestamp)"""
+        return min(session_data['last_activity'].timestamp() + self.timeout_seconds,
+                   session_data['started_at'].timestamp() + self.max_age_seconds)
+    
+    def _schedule_expiry(self, session_key: Tuple[str, str], session_data: Dict, not_before: float = 0.0):
+        """Добавляет сессию в кучу сроков истечения"""
+        deadline = max(self._get_expiry_deadline(session_data), not_before)
+        with self._expiry_lock:
+            heapq.heappush(self._expiry_heap, (deadline, session_key))
+    
+    def next_expiry_in(self) -> Optional[float]:
+        """Возвращает сколько секунд осталось до ближайшего истечения (None - сессий нет)"""
+        with self._expiry_lock:
+            if not self._expiry_heap:
+                return None
+            next_deadline = self._expiry_heap[0][0]
+        return max(0.0, next_deadline - datetime.now().timestamp())
     
-    def _find_recently_closed(self, session_key: str, hours: int = 1) -> Optional[Dict]:
+    def _find_recently_closed(self, session_key: Tuple[str, str], hours: int = 1) -> Optional[Dict]:
         """Находит недавно закрытую сессию для возможного возобновления"""
         if session_key not in self.closed_sessions:
             return None
@@ -36,7 +71,7 @@ class SessionManager:
 
         # ВАЖНО: Проверяем что сессия не прокомментирована и не имеет ended_at
         if not self._can_resume_session(last_session):
-            self.logger.debug(f"🚫 Session cannot be resumed: {session_key} (commented: {last_session.get('is_commented')}, ended_at: {last_session.get('ended_at')})")
+            self.logger.debug("🚫 Session cannot be resumed: %s (commented: %s, ended_at: %s)", session_key, last_session.get('is_commented'), last_session.get('ended_at'))
             return None
 
         # Проверяем, закрыта ли она в пределах указанного времени
@@ -53,8 +88,9 @@ class SessionManager:
         
         # Обновляем данные сессии
         resumed_session = session_data.copy()
-        resumed_session['last_activity'] = datetime.now()
-        resumed_session['resumed_at'] = datetime.now()
+        now = datetime.now()
+        resumed_session['last_activity'] = now
+        resumed_session['resumed_at'] = now
         resumed_session['resume_count'] = resumed_session.get('resume_count', 0) + 1
         resumed_session['hash_before'] = file_hash
         
@@ -70,6 +106,7 @@ class SessionManager:
         
         # Возвращаем в активные сессии
         self.active_sessions[session_key] = resumed_session
+        self._schedule_expiry(session_key, resumed_session)
         
         # Удаляем из истории закрытых, если она там есть
         if session_key in self.closed_sessions and session_data in self.closed_sessions[session_key]:
@@ -99,14 +136,11 @@ class SessionManager:
     
     def _is_session_expired(self, session_data: Dict) -> bool:
         """Проверяет истекла ли сессия"""
-        timeout_minutes = self.config.get('session_timeout_minutes', 30)
-        max_age_hours = self.config.get('max_session_hours', 3)
+        timeout_seconds = self.timeout_seconds
         
-        last_activity = session_data['last_activity']
-        session_age = datetime.now() - session_data['started_at']
-        
-        time_since_activity = datetime.now() - last_activity
-        timeout_seconds = timeout_minutes * 60
+        now = datetime.now()
+        session_age = now - session_data['started_at']
+        time_since_activity = now - session_data['last_activity']
         
         # Проверяем таймаут активности
         if time_since_activity.total_seconds() > timeout_seconds:
@@ -114,26 +148,33 @@ class SessionManager:
             return True
         
         # Проверяем максимальный возраст сессии
-        if session_age.total_seconds() > (max_age_hours * 3600):
+        if session_age.total_seconds() > self.max_age_seconds:
             self.logger.info(f"📅 Session expired by max age: {session_data['file_path']}, age: {session_age.total_seconds()/3600:.1f}h")
             return True
         
         return False
     
     def check_and_close_expired_sessions(self) -> List[Dict]:
-        """Проверяет и закрывает все просроченные сессии"""
+        """Проверяет и закрывает просроченные сессии, срок которых наступил по куче"""
         expired_sessions = []
         
-        total_sessions = len(self.active_sessions)
-        if total_sessions == 0:
+        now = datetime.now().timestamp()
+        due_keys = []
+        with self._expiry_lock:
+            while self._expiry_heap and self._expiry_heap[0][0] <= now:
+                due_keys.append(heapq.heappop(self._expiry_heap)[1])
+        
+        if not due_keys:
             return expired_sessions
             
-        self.logger.info(f"🔍 Checking {total_sessions} active sessions for expiration...")
-        
-        # Создаем копию списка для безопасной итерации
-        sessions_to_check = list(self.active_sessions.items())
+        self.logger.info(f"🔍 Checking {len(due_keys)} due sessions for expiration...")
         
-        for session_key, session_data in sessions_to_check:
+        for session_key in due_keys:
+            session_data = self.active_sessions.get(session_key)
+            if session_data is None:
+                # Сессия уже закрыта - запись в куче устарела
+                continue
+            
             try:
                 if self._is_session_expired(session_data):
                     file_path = session_data['file_path']
@@ -147,6 +188,9 @@ class SessionManager:
                     if closed_data:
                         expired_sessions.append(closed_data)
                         self.logger.info(f"✅ Session closed with ended_at: {closed_data['ended_at']}")
+                else:
+                    # Активность продлила сессию - переносим срок
+                    self._schedule_expiry(session_key, session_data, not_before=now + 0.5)
                         
             except Exception as e:
                 self.logger.error(f"❌ Error checking session {session_key}: {e}")
@@ -154,7 +198,7 @@ class SessionManager:
         if expired_sessions:
             self.logger.info(f"✅ Closed {len(expired_sessions)} expired sessions")
         else:
-            self.logger.debug(f"📊 All {total_sessions} sessions are active")
+            self.logger.debug("📊 All %s due sessions are still active", len(due_keys))
         
         return expired_sessions
     
@@ -200,13 +244,14 @@ class SessionManager:
         """Создает новую сессию"""
         session_key = self._get_session_key(file_path, username)
         
+        now = datetime.now()
         session_data = {
             'session_id': str(uuid.uuid4()),
             'file_path': file_path,
             'file_name': os.path.basename(file_path),
             'username': username,
-            'started_at': datetime.now(),
-            'last_activity': datetime.now(),
+            'started_at': now,
+            'last_activity': now,
             'resume_count': 0,
             'hash_before': file_hash,
             'hash_after': None,
@@ -214,6 +259,7 @@ class SessionManager:
         }
         
         self.active_sessions[session_key] = session_data
+        self._schedule_expiry(session_key, session_data)
         self.logger.info(f"🆕 New session created: {file_path} by {username}")
         
         return session_data
@@ -258,7 +304,7 @@ class SessionManager:
             session_key = self._get_session_key(file_path, username)
 
             if session_key not in self.active_sessions:
-                self.logger.debug(f"ℹ️ No active session to close: {session_key}")
+                self.logger.debug("ℹ️ No active session to close: %s", session_key)
                 return None
 
             session_data = self.active_sessions[session_key]
@@ -301,14 +347,21 @@ class SessionManager:
         """Очищает просроченные сессии и возвращает данные для обработки"""
         expired_sessions = self.check_and_close_expired_sessions()
         
+        # Хеши всех файлов вычисляются параллельно в пуле обработчика событий
+        file_hashes = event_handler._hash_files_parallel(
+            session_data['file_path'] for session_data in expired_sessions
+        )
+        
+        # Одна метка времени на весь пакет событий закрытия
+        now_iso = datetime.now().isoformat()
         for session_data in expired_sessions:
             file_path = session_data['file_path']
             username = session_data['username']
             
             # Получаем хеш файла если он существует
             file_hash = None
-            if os.path.exists(file_path) and event_handler.config.get('hashing', {}).get('enabled', True):
-                file_hash = event_handler.hash_calculator.calculate_file_hash_with_retry(file_path)
+            if event_handler.hashing_enabled:
+                file_hash = file_hashes.get(file_path)
                 session_data['hash_after'] = file_hash
             
             # Отправляем событие закрытия
@@ -323,10 +376,10 @@ class SessionManager:
                 'session_started_at': session_data['started_at'].isoformat(),
                 'session_ended_at': session_data['ended_at'].isoformat(),
                 'source': 'background_checker',
-                'event_timestamp': datetime.now().isoformat()
+                'event_timestamp': now_iso
             }
             
-            success = event_handler.api_client.send_event(event_data)
+            success = event_handler._send_event_ordered(event_data)
             if not success:
                 event_handler.logger.error(f"Failed to send closed event for expired session: {file_path}")
         
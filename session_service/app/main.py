@@ -2,6 +2,7 @@
 import sys
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import asyncio
 # Добавляем корень проекта в PYTHONPATH
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -18,6 +19,12 @@ from datetime import datetime, timedelta
 from .schemas import FileSessionCreate
 from .crud import get_active_session_by_user_and_file, create_file_session, update_file_session_activity
 
+# Одна HTTP-сессия для запросов к агентам: keep-alive соединения переиспользуются между вызовами
+agent_http = requests.Session()
+_agent_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32)
+agent_http.mount('http://', _agent_adapter)
+agent_http.mount('https://', _agent_adapter)
+
 async def notify_agents_about_event(endpoint: str, data: dict):
     """Асинхронно уведомляет агенты о событиях"""
     # Получаем список агентов из конфигурации
@@ -26,7 +33,7 @@ async def notify_agents_about_event(endpoint: str, data: dict):
     async def notify_agent(agent_url: str):
         try:
             full_url = f"{agent_url}/api/agent/{endpoint}"
-            response = requests.post(
+            response = agent_http.post(
                 full_url,
                 json=data,
                 timeout=5
@@ -48,7 +55,7 @@ async def sync_sessions_with_agents(db: Session):
     agents = api_config.get('agents', ['http://localhost:8080'])
     for agent_url in agents:
         try:
-            response = requests.get(f"{agent_url}/api/agent/active-sessions", timeout=5)
+            response = agent_http.get(f"{agent_url}/api/agent/active-sessions", timeout=5)
             if response.status_code == 200:
                 agent_sessions = response.json().get("sessions", [])
                 # Создаём множество ключей сессий агента для быстрого поиска
@@ -174,6 +181,23 @@ async def create_event(event_data: dict, db: Session = Depends(get_db)):
         print(f"❌ Error processing event: {e}")
         raise HTTPException(status_code=500, detail=f"Error processing event: {str(e)}")
 
+@app.post("/api/events/batch")
+async def create_events_batch(events: List[dict], db: Session = Depends(get_db)):
+    """Эндпоинт для пакетного приема событий от мониторинга (порядок событий сохраняется)"""
+    print(f"📨 Received batch of {len(events)} events")
+
+    results = []
+    for event_data in events:
+        try:
+            result = await process_file_event(db, event_data)
+            results.append({"status": "processed", "event_type": event_data.get('event_type'), "result": result})
+        except Exception as e:
+            print(f"❌ Error processing event in batch: {e}")
+            db.rollback()
+            results.append({"status": "error", "event_type": event_data.get('event_type'), "detail": str(e)})
+
+    return {"status": "processed", "count": len(events), "results": results}
+
 async def process_file_event(db: Session, event_data: dict):
     """Обрабатывает файловое событие и создает/обновляет сессии"""
     event_type = event_data.get('event_type')